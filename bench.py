@@ -0,0 +1,212 @@
+import argparse
+import json
+import platform
+import random
+import time
+import tracemalloc
+import numpy as np
+import cfg
+from board import calc_next_board
+from minimax import Minimax
+from memory import ReplayBuffer, ArrayReplayBuffer
+from evaluate import array_to_keys
+from vecenv import VecGame, random_policy
+
+WIDTH = cfg.WIDTH
+HEIGHT = cfg.HEIGHT
+STREAK = cfg.STREAK
+
+# opening, middle game and late positions, as the columns played from the empty board
+POSITIONS = [
+    [],
+    [2, 2],
+    [2, 1, 2, 3, 0],
+    [2, 2, 1, 3, 3, 1, 0, 4],
+    [0, 1, 2, 3, 4, 0, 1, 2, 3, 4, 2, 2],
+    [2, 2, 2, 1, 3, 3, 1, 1, 4, 0, 0, 3, 4, 4],
+]
+
+# metrics where lower is better, all others are throughputs
+LOWER_IS_BETTER = ('replay_bytes_per_1e5', 'array_replay_bytes_per_1e5')
+
+def position(moves, width=WIDTH, height=HEIGHT):
+    """ (board, color to move) after playing 'moves' from the empty board, 'x' first
+    """
+    board = [[' ']*width for _ in range(height)]
+    color = 'x'
+    for move in moves:
+        board = calc_next_board(board, move, color)
+        color = 'o' if color == 'x' else 'x'
+    return board, color
+
+def bench_search(depths, min_time):
+    """ Nodes per second of Minimax.best_move and Minimax.search at every depth
+    """
+    results = {}
+    for name in ('best_move', 'search'):
+        for depth in depths:
+            nodes, elapsed = 0, 0.0
+            while elapsed < min_time:
+                for moves in POSITIONS:
+                    board, color = position(moves)
+                    # a new Minimax per position, so the transposition table starts empty
+                    minimax = Minimax(color, tt_memory=2**20)
+                    start = time.perf_counter()
+                    getattr(minimax, name)(depth, board, color)
+                    elapsed += time.perf_counter() - start
+                    nodes += minimax.nodes
+            results[f'{name}_depth{depth}_nodes_per_sec'] = nodes / elapsed
+    return results
+
+def bench_eval(min_time):
+    """ Leaf evaluations per second of Minimax.value
+    """
+    boards = [position(moves) for moves in POSITIONS]
+    minimax = Minimax('x')
+    count, start = 0, time.perf_counter()
+    while time.perf_counter() - start < min_time:
+        for board, color in boards:
+            minimax.value(board, color)
+        count += len(boards)
+    return {'value_evals_per_sec': count / (time.perf_counter() - start)}
+
+def bench_games(num_games):
+    """ Games per second of headless Game self-play with its default players
+    """
+    from connect4 import Game
+    g = Game(headless=True)
+    start = time.perf_counter()
+    for _ in range(num_games):
+        while not g.finished:
+            g.next_move()
+        g.new_game()
+    return {'game_games_per_sec': num_games / (time.perf_counter() - start)}
+
+def random_transitions(n, seed=0):
+    """ n (state, action, next_state, reward, done) arrays from random VecGame play
+    """
+    env = VecGame(1024)
+    rng = np.random.default_rng(seed)
+    columns = [[] for _ in range(5)]
+    count = 0
+    while count < n:
+        states = array_to_keys(env.boards)
+        actions = random_policy(env.legal_mask(), rng)
+        before = env.boards.copy()
+        pieces = env.turn.copy()
+        rewards, dones, _ = env.step(actions)
+        after = env.boards.copy()
+        # finished games are reset by step(), rebuild their final boards
+        index = np.flatnonzero(dones)
+        after[index] = before[index]
+        heights = (before[index, :, actions[index]] != 0).sum(axis=1)
+        after[index, np.minimum(heights, env.height-1), actions[index]] = pieces[index]
+        for column, values in zip(columns, (states, actions, array_to_keys(after), rewards, dones)):
+            column.append(values)
+        count += env.num_games
+    return [np.concatenate(column)[:n] for column in columns]
+
+def bench_update(batch_size, min_time):
+    """ Transitions per second of QPlayer.update, plain and prioritized
+    """
+    from player import QPlayer
+    transitions = list(zip(*random_transitions(int(1e5))))
+    results = {}
+    for prioritized in (False, True):
+        player = QPlayer('bench', 'x', batch_size=batch_size, prioritized=prioritized,
+                         reward_shaping=None)
+        for state, action, next_state, reward, done in transitions:
+            player.buffer.push(int(state), int(action), int(next_state), float(reward), bool(done))
+        count, start = 0, time.perf_counter()
+        while time.perf_counter() - start < min_time:
+            player.update()
+            count += batch_size
+        name = 'update_prioritized' if prioritized else 'update'
+        results[f'{name}_transitions_per_sec'] = count / (time.perf_counter() - start)
+    return results
+
+def bench_memory(entries=int(1e5)):
+    """ Peak bytes allocated by a replay buffer holding 'entries' transitions,
+        scaled to 1e5 entries
+    """
+    states, actions, next_states, rewards, dones = random_transitions(entries)
+    results = {}
+    for name, cls in (('replay', ReplayBuffer), ('array_replay', ArrayReplayBuffer)):
+        tracemalloc.start()
+        buffer = cls(entries, 1, 0.4, 0.6, False)
+        for i in range(entries):
+            buffer.push(int(states[i]), int(actions[i]), int(next_states[i]),
+                        float(rewards[i]), bool(dones[i]))
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del buffer
+        results[f'{name}_bytes_per_1e5'] = peak * 1e5 / entries
+    return results
+
+def run(quick=False):
+    """ Run every benchmark, return {metric: value}
+    """
+    random.seed(0)
+    np.random.seed(0)
+    min_time = 0.2 if quick else 1.0
+    results = {}
+    results.update(bench_search((2, 3) if quick else (2, 3, 4), min_time))
+    results.update(bench_eval(min_time))
+    results.update(bench_games(2 if quick else 10))
+    results.update(bench_update(1000, min_time))
+    results.update(bench_memory(int(1e4) if quick else int(1e5)))
+    return results
+
+def best_of(runs):
+    """ Best value of every metric over several runs, which filters out noise
+        from other processes better than the mean
+    """
+    pick = {name: min if name in LOWER_IS_BETTER else max for name in runs[0]}
+    return {name: pick[name](run[name] for run in runs) for name in runs[0]}
+
+def compare(results, baseline, tolerance):
+    """ Metrics more than 'tolerance' (a fraction) worse than the baseline,
+        as a list of (metric, value, baseline value)
+    """
+    regressions = []
+    for name, base in baseline.items():
+        if name not in results:
+            continue
+        value = results[name]
+        if name in LOWER_IS_BETTER:
+            worse = value > base * (1 + tolerance)
+        else:
+            worse = value < base * (1 - tolerance)
+        if worse:
+            regressions.append((name, value, base))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark search, evaluation and self-play')
+    parser.add_argument('--out', default='data/bench.json', help='where to write the results')
+    parser.add_argument('--baseline', help='results file to compare against, e.g. data/bench_baseline.json')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown (or memory growth) as a fraction of the baseline')
+    parser.add_argument('--quick', action='store_true', help='shorter runs, for a smoke test')
+    parser.add_argument('--repeat', type=int, default=3, help='keep the best of this many runs')
+    args = parser.parse_args()
+
+    results = best_of([run(args.quick) for _ in range(args.repeat)])
+    for name, value in results.items():
+        print(f'{name:45s} {value:14.1f}')
+    with open(args.out, 'w') as f:
+        json.dump({'python': platform.python_version(), 'quick': args.quick,
+                   'repeat': args.repeat, 'metrics': results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['metrics']
+        regressions = compare(results, baseline, args.tolerance)
+        for name, value, base in regressions:
+            print(f'REGRESSION {name}: {value:.1f} vs baseline {base:.1f}')
+        if regressions:
+            raise SystemExit(1)
+        print(f'no regressions beyond {args.tolerance:.0%} of {args.baseline}')
+
+if __name__ == '__main__':
+    main()
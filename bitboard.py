@@ -0,0 +1,246 @@
+import random
+import cfg
+
+HEIGHT = cfg.HEIGHT
+WIDTH = cfg.WIDTH
+STREAK = cfg.STREAK
+
+COLORS = ('x', 'o')
+
+_zobrist_keys = {}
+
+def zobrist_keys(width, height):
+    """ Random 64-bit keys for every (player, bit index) pair, plus one key for 'o' to move.
+        Seeded, so hashes are the same across processes and runs.
+    """
+    if (width, height) not in _zobrist_keys:
+        rng = random.Random(width*100 + height)
+        cells = width*(height+1)
+        _zobrist_keys[(width, height)] = ([rng.getrandbits(64) for _ in range(cells)],
+                                          [rng.getrandbits(64) for _ in range(cells)],
+                                          rng.getrandbits(64))
+    return _zobrist_keys[(width, height)]
+
+_mirror_zobrist_keys = {}
+
+def mirror_zobrist_keys(width, height):
+    """ Zobrist keys of the left-right mirrored cell, so that the hash of the mirrored
+        position can be kept up to date alongside the normal one
+    """
+    if (width, height) not in _mirror_zobrist_keys:
+        keys = zobrist_keys(width, height)
+        mirror = [(width-1 - index // (height+1))*(height+1) + index % (height+1)
+                  for index in range(width*(height+1))]
+        _mirror_zobrist_keys[(width, height)] = ([keys[0][i] for i in mirror],
+                                                 [keys[1][i] for i in mirror])
+    return _mirror_zobrist_keys[(width, height)]
+
+class BitBoard(object):
+    """ Compact connect n state made of two integer bitboards and column heights.
+
+        Bit (col*(height+1) + row) is set in pieces[p] if player p ('x' = 0, 'o' = 1)
+        has a piece at board[row][col]. Every column keeps one extra empty bit on top,
+        so the shift-and-mask streak checks never wrap from one column to the next.
+    """
+
+    def __init__(self, width=WIDTH, height=HEIGHT, streak=STREAK):
+        self.width = width
+        self.height = height
+        self.streak = streak
+        self.pieces = [0, 0]
+        self.mask = 0
+        self.heights = [0]*width
+        self.moves = [] # stack of (column, player index) for undo
+        self.zobrist = zobrist_keys(width, height)
+        self.mirror_zobrist = mirror_zobrist_keys(width, height)
+        self.hash = 0 # incremental Zobrist hash of the pieces
+        self.mirror_hash = 0 # same for the left-right mirrored position
+
+        self.bottom = 0
+        for col in range(width):
+            self.bottom |= 1 << col*(height+1)
+        self.board_mask = self.bottom * ((1 << height) - 1)
+        # bit shifts for vertical, horizontal, diagonal ↘ and diagonal ↗ lines
+        self.shifts = (1, height+1, height, height+2)
+
+    @classmethod
+    def from_board(cls, board, streak=STREAK):
+        """ Build a BitBoard from a list-of-lists board (board[0] is the lowest row).
+            Highlighted (upper case) pieces are read as normal pieces.
+            The move history is unknown, so only moves played afterwards can be undone.
+        """
+        height = len(board)
+        width = len(board[0])
+        bb = cls(width, height, streak)
+        for col in range(width):
+            for row in range(height):
+                cell = board[row][col].lower()
+                if cell == ' ':
+                    break
+                bit = 1 << col*(height+1) + row
+                bb.pieces[COLORS.index(cell)] |= bit
+                bb.mask |= bit
+                bb.heights[col] += 1
+                bb.hash ^= bb.zobrist[COLORS.index(cell)][col*(height+1) + row]
+                bb.mirror_hash ^= bb.mirror_zobrist[COLORS.index(cell)][col*(height+1) + row]
+        return bb
+
+    def to_board(self):
+        """ Return the state as a list-of-lists board of one-char strings
+        """
+        board = []
+        for row in range(self.height):
+            board.append([])
+            for col in range(self.width):
+                bit = 1 << col*(self.height+1) + row
+                if self.pieces[0] & bit:
+                    board[row].append(COLORS[0])
+                elif self.pieces[1] & bit:
+                    board[row].append(COLORS[1])
+                else:
+                    board[row].append(' ')
+        return board
+
+    def copy(self):
+        bb = BitBoard.__new__(BitBoard)
+        bb.__dict__.update(self.__dict__)
+        bb.pieces = self.pieces[:]
+        bb.heights = self.heights[:]
+        bb.moves = self.moves[:]
+        return bb
+
+    def num_pieces(self):
+        return bin(self.mask).count('1')
+
+    def color_to_move(self):
+        """ 'x' always goes first, so the side to move follows from the piece count
+        """
+        return COLORS[self.num_pieces() % 2]
+
+    def can_play(self, col):
+        return self.heights[col] < self.height
+
+    def legal_mask(self):
+        """ Bitmask of the cells where a piece would land, one per non-full column
+        """
+        return (self.mask + self.bottom) & self.board_mask
+
+    def legal_moves(self):
+        """ List of columns that are not full, left to right
+        """
+        return [col for col in range(self.width) if self.heights[col] < self.height]
+
+    def play(self, col, color):
+        """ Drop a piece of 'color' in column 'col'. The column must not be full.
+        """
+        p = COLORS.index(color.lower())
+        index = col*(self.height+1) + self.heights[col]
+        bit = 1 << index
+        self.pieces[p] |= bit
+        self.mask |= bit
+        self.heights[col] += 1
+        self.hash ^= self.zobrist[p][index]
+        self.mirror_hash ^= self.mirror_zobrist[p][index]
+        self.moves.append((col, p))
+
+    def undo(self):
+        """ Take back the last move played with play(). Returns its column.
+        """
+        col, p = self.moves.pop()
+        self.heights[col] -= 1
+        index = col*(self.height+1) + self.heights[col]
+        bit = 1 << index
+        self.pieces[p] ^= bit
+        self.mask ^= bit
+        self.hash ^= self.zobrist[p][index]
+        self.mirror_hash ^= self.mirror_zobrist[p][index]
+        return col
+
+    def is_win(self, color):
+        """ True if 'color' has at least one streak of length self.streak
+        """
+        return self._has_streak(self.pieces[COLORS.index(color.lower())])
+
+    def is_winning_move(self, col, color):
+        """ True if dropping 'color' in column 'col' makes a streak, without playing it
+        """
+        bit = 1 << col*(self.height+1) + self.heights[col]
+        return self._has_streak(self.pieces[COLORS.index(color.lower())] | bit)
+
+    def _has_streak(self, b):
+        for s in self.shifts:
+            m = b
+            for i in range(1, self.streak):
+                m &= b >> s*i
+                if not m:
+                    break
+            if m:
+                return True
+        return False
+
+    def key(self):
+        """ Unique integer code of the position.
+            (mask + bottom) sets the first empty cell of every column, which marks
+            where each column ends; the 'x' pieces fill in the cells below the marker.
+        """
+        return self.pieces[0] | (self.mask + self.bottom)
+
+    @classmethod
+    def from_key(cls, key, width=WIDTH, height=HEIGHT, streak=STREAK):
+        """ Inverse of key()
+        """
+        bb = cls(width, height, streak)
+        for col in range(width):
+            column = (key >> col*(height+1)) & ((1 << height+1) - 1)
+            h = column.bit_length() - 1
+            bb.heights[col] = h
+            col_mask = ((1 << h) - 1) << col*(height+1)
+            bb.mask |= col_mask
+            bb.pieces[0] |= key & col_mask
+        bb.pieces[1] = bb.mask ^ bb.pieces[0]
+        for p in range(2):
+            for index in range(width*(height+1)):
+                if bb.pieces[p] >> index & 1:
+                    bb.hash ^= bb.zobrist[p][index]
+                    bb.mirror_hash ^= bb.mirror_zobrist[p][index]
+        return bb
+
+    def search_hash(self, color):
+        """ Zobrist hash of the position with 'color' to move
+        """
+        return self.hash if color == COLORS[0] else self.hash ^ self.zobrist[2]
+
+    def canonical_search_hash(self, color):
+        """ (hash, flipped): the smaller of search_hash of the position and of its mirror,
+            and whether the mirror was taken, in which case moves must go through mirror_move
+        """
+        side = 0 if color == COLORS[0] else self.zobrist[2]
+        h, m = self.hash ^ side, self.mirror_hash ^ side
+        return (m, True) if m < h else (h, False)
+
+    def mirror_key(self):
+        """ key() of the left-right mirrored position
+        """
+        key = self.key()
+        column_mask = (1 << self.height+1) - 1
+        mirrored = 0
+        for col in range(self.width):
+            column = (key >> col*(self.height+1)) & column_mask
+            mirrored |= column << (self.width-1 - col)*(self.height+1)
+        return mirrored
+
+    def canonical_key(self):
+        """ (key, flipped): the smaller of key() and mirror_key(), and whether the mirror
+            was taken. A position and its mirror share the same canonical key.
+        """
+        key, mirrored = self.key(), self.mirror_key()
+        return (mirrored, True) if mirrored < key else (key, False)
+
+    def mirror_move(self, col):
+        return self.width-1 - col
+
+    def __eq__(self, other):
+        return self.pieces == other.pieces and self.width == other.width and self.height == other.height
+
+    def __hash__(self):
+        return hash(self.key())
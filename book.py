@@ -0,0 +1,86 @@
+import argparse
+import numpy as np
+import cfg
+from bitboard import BitBoard
+from minimax import Minimax
+
+WIDTH = cfg.WIDTH
+HEIGHT = cfg.HEIGHT
+STREAK = cfg.STREAK
+
+BOOK_DTYPE = np.dtype([('key', np.int64), ('move', np.int8)])
+
+def opening_positions(max_ply, width=WIDTH, height=HEIGHT, streak=STREAK):
+    """ BitBoards of every unfinished position with fewer than max_ply pieces, by key(),
+        'x' moving first
+    """
+    positions = {}
+    frontier = [BitBoard(width, height, streak)]
+    for ply in range(max_ply):
+        next_frontier = []
+        for bb in frontier:
+            key = bb.key()
+            if key in positions:
+                continue
+            positions[key] = bb
+            color = bb.color_to_move()
+            for col in bb.legal_moves():
+                if bb.is_winning_move(col, color):
+                    continue
+                child = bb.copy()
+                child.play(col, color)
+                next_frontier.append(child)
+        frontier = next_frontier
+    return positions
+
+def build_book(max_ply, depth, width=WIDTH, height=HEIGHT, streak=STREAK):
+    """ Best move of the side to move, searched 'depth' plies deep with Minimax, for all
+        positions with fewer than max_ply pieces. Returns a key-sorted BOOK_DTYPE array
+        of keys and moves.
+
+        A position and its mirror image are stored separately: the default check_streak
+        heuristic is not mirror-symmetric, so mirroring the move of one would not always
+        give a best move of the other.
+    """
+    positions = opening_positions(max_ply, width, height, streak)
+    searchers = {color: Minimax(color, streak) for color in ('x', 'o')}
+    book = np.zeros(len(positions), dtype=BOOK_DTYPE)
+    for i, (key, bb) in enumerate(sorted(positions.items())):
+        color = bb.color_to_move()
+        move, _ = searchers[color].search(depth, bb.to_board(), color)
+        book[i] = (key, move)
+    return book
+
+class OpeningBook(object):
+    """ Precomputed moves looked up by position key in O(log n)
+    """
+
+    def __init__(self, path='data/book.npy'):
+        self.path = path
+        self.book = np.load(path, mmap_mode='r')
+        self.keys = self.book['key']
+
+    def lookup(self, board):
+        """ Book move for the side to move on a list-of-lists board, or None
+        """
+        key = BitBoard.from_board(board).key()
+        i = int(np.searchsorted(self.keys, key))
+        if i == len(self.keys) or self.keys[i] != key:
+            return None
+        return int(self.book['move'][i])
+
+    def __len__(self):
+        return len(self.keys)
+
+def main():
+    parser = argparse.ArgumentParser(description='Precompute an opening book')
+    parser.add_argument('--ply', type=int, default=6, help='cover positions with fewer pieces than this')
+    parser.add_argument('--depth', type=int, default=6, help='search depth for every position')
+    parser.add_argument('--out', default='data/book.npy')
+    args = parser.parse_args()
+    book = build_book(args.ply, args.depth)
+    np.save(args.out, book)
+    print(f'{len(book)} positions written to {args.out}')
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,4 @@
 HEIGHT=6
 WIDTH=5
 STREAK=4
+TT_MEMORY=2**24
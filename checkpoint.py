@@ -0,0 +1,187 @@
+import os
+import json
+import argparse
+import numpy as np
+
+MANIFEST = 'manifest.json'
+
+def segment_dtype(width):
+    return np.dtype([('key', np.int64), ('values', np.float64, (width,)), ('count', np.int64)])
+
+def _atomic_write(path, write):
+    """ Write a file through a temporary name, fsync it and rename it into place,
+        so a crash leaves either the old file or the complete new one
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def read_manifest(path):
+    """ Return the checkpoint manifest, or an empty one if there is no checkpoint yet
+    """
+    try:
+        with open(os.path.join(path, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'segments': [], 'next_segment': 0, 'epsilon': None}
+
+def _write_manifest(path, manifest):
+    _atomic_write(os.path.join(path, MANIFEST),
+                  lambda f: f.write(json.dumps(manifest).encode()))
+
+def _write_segment(path, manifest, rows):
+    name = f'segment-{manifest["next_segment"]:06d}.npy'
+    _atomic_write(os.path.join(path, name), lambda f: np.save(f, rows))
+    manifest['next_segment'] += 1
+    return name
+
+def write_checkpoint(path, qtable, epsilon, max_segments=16, reset=False):
+    """ Append the rows of 'qtable' changed since the last checkpoint as a new segment.
+
+        A checkpoint is a directory of segments (.npy arrays of key, values, count
+        sorted by key) and a manifest listing them, oldest first. Replacing the manifest
+        is the commit point: a segment written before a crash but not yet listed is
+        ignored, and overwritten by the next checkpoint. When there are more than
+        max_segments segments they are merged into one.
+        reset=True starts a new checkpoint in place of whatever 'path' held, with every
+        row of 'qtable' and of its backing checkpoint, changed or not.
+    """
+    os.makedirs(path, exist_ok=True)
+    manifest = read_manifest(path)
+    stale = []
+    if reset:
+        stale = manifest['segments']
+        manifest['segments'] = []
+        slots = np.flatnonzero(qtable.keys != 0)
+    else:
+        slots = np.flatnonzero(qtable.dirty & (qtable.keys != 0))
+
+    rows = np.zeros(len(slots), dtype=segment_dtype(qtable.width))
+    rows['key'] = qtable.keys[slots]
+    rows['values'] = qtable.values[slots]
+    rows['count'] = qtable.counts[slots]
+    rows.sort(order='key')
+    if reset and qtable.backing is not None and len(qtable.backing):
+        # rows of the loaded checkpoint that were never read into memory
+        rows = _newest_rows([rows, qtable.backing.rows()])
+    if len(rows):
+        manifest['segments'].append(_write_segment(path, manifest, rows))
+    manifest['epsilon'] = epsilon
+    _write_manifest(path, manifest)
+    qtable.dirty[:] = False
+    for name in stale:
+        os.remove(os.path.join(path, name))
+
+    if len(manifest['segments']) > max_segments:
+        compact(path)
+
+def compact(path):
+    """ Merge all segments into one, keeping the newest row of every key
+    """
+    manifest = read_manifest(path)
+    old = manifest['segments']
+    if len(old) <= 1:
+        return
+    rows = _merged_rows(path, old)
+    manifest['segments'] = [_write_segment(path, manifest, rows)]
+    _write_manifest(path, manifest)
+    for name in old:
+        os.remove(os.path.join(path, name))
+
+def _merged_rows(path, segments):
+    """ Rows of all 'segments', sorted by key, keeping the newest row of every key
+    """
+    return _newest_rows([np.load(os.path.join(path, name)) for name in reversed(segments)])
+
+def _newest_rows(row_arrays):
+    """ Rows of 'row_arrays', newest first, sorted by key with the newest row of every key
+    """
+    rows = np.concatenate(row_arrays)
+    # np.unique returns the first occurrence, which is the newest
+    _, first = np.unique(rows['key'], return_index=True)
+    return rows[first]
+
+def export(path, out):
+    """ Turn the checkpoint at 'path' into a read-only serving index in directory 'out':
+        keys.npy (sorted int64 codes) and values.npy (float64 Q rows in the same order),
+        meant to be memory-mapped by qtable.FrozenQTable
+    """
+    manifest = read_manifest(path)
+    if manifest['segments']:
+        rows = _merged_rows(path, manifest['segments'])
+    else:
+        rows = np.zeros(0, dtype=segment_dtype(0))
+    os.makedirs(out, exist_ok=True)
+    _atomic_write(os.path.join(out, 'values.npy'),
+                  lambda f: np.save(f, np.ascontiguousarray(rows['values'])))
+    # keys last: a complete keys.npy means values.npy is complete too
+    _atomic_write(os.path.join(out, 'keys.npy'),
+                  lambda f: np.save(f, np.ascontiguousarray(rows['key'])))
+
+class CheckpointReader(object):
+    """ Read-only view of a checkpoint with every segment memory-mapped.
+
+        Nothing is deserialized up front: get() binary-searches the sorted keys of the
+        segments, newest first, and only touches the pages it needs.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.manifest = read_manifest(path)
+        self.epsilon = self.manifest['epsilon']
+        self.segments = [np.load(os.path.join(path, name), mmap_mode='r')
+                         for name in reversed(self.manifest['segments'])]
+        self.keys = [segment['key'] for segment in self.segments]
+
+    def get(self, key):
+        """ (values, count) of 'key' from the newest segment holding it, or None
+        """
+        for segment, keys in zip(self.segments, self.keys):
+            i = np.searchsorted(keys, key)
+            if i < len(keys) and keys[i] == key:
+                return np.array(segment['values'][i]), int(segment['count'][i])
+        return None
+
+    def rows(self):
+        """ Every row of a non-empty checkpoint, sorted by key, newest row of every key
+        """
+        return _newest_rows(self.segments)
+
+    def __contains__(self, key):
+        for keys in self.keys:
+            i = np.searchsorted(keys, key)
+            if i < len(keys) and keys[i] == key:
+                return True
+        return False
+
+    def __len__(self):
+        """ Number of rows over all segments, counting a key once per segment
+        """
+        return sum(len(keys) for keys in self.keys)
+
+    def __getstate__(self):
+        # memory maps are reopened rather than pickled
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+def main():
+    parser = argparse.ArgumentParser(description='Q table checkpoint tools')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    p = subparsers.add_parser('export', help='write a memory-mappable serving index')
+    p.add_argument('path', help='checkpoint directory, e.g. data/Q')
+    p.add_argument('out', help='output directory, e.g. data/Q-serve')
+    p = subparsers.add_parser('compact', help='merge all segments into one')
+    p.add_argument('path')
+    args = parser.parse_args()
+    if args.command == 'export':
+        export(args.path, args.out)
+    else:
+        compact(args.path)
+
+if __name__ == '__main__':
+    main()
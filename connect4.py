@@ -9,11 +9,13 @@
 
 import random
 import os
+import time
 from player import *
 import cfg
 import numpy as np
 import logging
 from board import *
+from records import GameRecorder, X_WIN, O_WIN, DRAW
 
 WIDTH = cfg.WIDTH
 HEIGHT = cfg.HEIGHT
@@ -32,33 +34,45 @@ class Game(object):
     game_name = u"Connecter Quatre\u2122" # U+2122 is "tm" this is a joke
     colors = ["x", "o"]
     
-    def __init__(self, width = WIDTH, height = HEIGHT, streak = STREAK, verbose=True):
+    def __init__(self, width = WIDTH, height = HEIGHT, streak = STREAK, verbose=True,
+                 headless=False, record=None, reward_shaping='minimax'):
+        """ headless skips logging and rendering altogether, for self-play at full speed.
+            record is a path; every finished game is appended to it (see records.py).
+            reward_shaping is passed to the QPlayer, see QPlayer.calc_reward.
+        """
         self.round = 1
         self.finished = False
         self.winner = None
         self.width = width
         self.height = height
-        self.verbose = verbose
+        self.verbose = verbose and not headless
+        self.headless = headless
         self.streak = streak
+        self.moves = [] # columns played in this game
+        self.recorder = GameRecorder(record, width, height, streak) if record is not None else None
         
         # logging
-        logging.basicConfig(format='%(message)s', level=logging.DEBUG if verbose else logging.INFO) 
         self.logger = logging.getLogger("connect4")
-        self.handler = logging.StreamHandler()
-        self.handler.setLevel(logging.DEBUG if verbose else logging.INFO) 
-        
-        self.formatter = logging.Formatter('%(message)s')
-        self.handler.setFormatter(self.formatter)
+        if not headless:
+            logging.basicConfig(format='%(message)s', level=logging.DEBUG if verbose else logging.INFO) 
+            self.handler = logging.StreamHandler()
+            self.handler.setLevel(logging.DEBUG if verbose else logging.INFO) 
+            
+            self.formatter = logging.Formatter('%(message)s')
+            self.handler.setFormatter(self.formatter)
         
         diff = 1
         # do cross-platform clear screen
 #        os.system( [ 'clear', 'cls' ][ os.name == 'nt' ] )
-        self.players[0] = QPlayer("Player 1", self.colors[0], batch_size=1e3)
+        self.players[0] = QPlayer("Player 1", self.colors[0], batch_size=1e3,
+                                  reward_shaping=reward_shaping)
 #        self.players[0] = HumanPlayer("Player 1", self.colors[0])
-        self.logger.debug("{0} will be {1}".format(self.players[0].name, self.colors[0]))
+        if not headless:
+            self.logger.debug("{0} will be {1}".format(self.players[0].name, self.colors[0]))
         
         self.players[1] = MiniMaxPlayer("Player 2", self.colors[1], diff+1)
-        self.logger.debug("{0} will be {1}".format(self.players[1].name, self.colors[1]))
+        if not headless:
+            self.logger.debug("{0} will be {1}".format(self.players[1].name, self.colors[1]))
         
         # x always goes first (arbitrary choice on my part)
         self.turn = self.players[0]
@@ -75,6 +89,7 @@ class Game(object):
         self.round = 1
         self.finished = False
         self.winner = None
+        self.moves = []
         
         # x always goes first (arbitrary choice on my part)
         self.turn = self.players[0]
@@ -102,23 +117,71 @@ class Game(object):
         if self.round > self.width*self.height:
             self.finished = True
             # this would be a stalemate :(
+            self.record_game()
             return
         
         # move is the column that player want's to play
-        self.logger.debug("{0}'s turn.  {0} is {1}".format(player.name, player.color))
+        if not self.headless:
+            self.logger.debug("{0}'s turn.  {0} is {1}".format(player.name, player.color))
         move = player.move(self.board)
 
+        if self.drop(move):
+            if self.finished:
+                self.record_game()
+            if self.verbose:
+                self.print_state()
+            return
+        # if we get here, then the column is full
+        if not self.headless:
+            self.logger.debug("Invalid move (column is full)")
+        return
+
+    def drop(self, move):
+        """ Put the piece of the player to move in column 'move' and pass the turn.
+            Return False, changing nothing, if the column is full.
+        """
         for i in range(self.height):
             if self.board[i][move] == ' ':
-                self.board[i][move] = player.color
+                self.board[i][move] = self.turn.color
+                self.moves.append(move)
                 self.switch_turn()
-                self.find_streak()
-                if self.verbose:
-                    self.print_state()
-                return
-        # if we get here, then the column is full
-        self.logger.debug("Invalid move (column is full)")
-        return
+                self.find_streak_at(i, move)
+                return True
+        return False
+
+    def record_game(self):
+        """ Append the finished game to the record file, if there is one
+        """
+        if self.recorder is None:
+            return
+        if self.winner is None:
+            result = DRAW
+        else:
+            result = X_WIN if self.winner.color == 'x' else O_WIN
+        self.recorder.write(self.moves, result)
+
+    def close(self):
+        """ Write out the games still buffered by the recorder and close its file,
+            then release what the players hold, e.g. search processes
+        """
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+        for player in self.players:
+            player.close()
+
+    def replay(self, moves, show=False, delay=0.5):
+        """ Start a new game and play the recorded 'moves' into it, e.g. from
+            records.read_games. With show, print the board after every move.
+        """
+        self.new_game()
+        for move in moves:
+            self.drop(move)
+            if show:
+                self.print_state()
+                time.sleep(delay)
+        if len(moves) == self.width*self.height and not self.finished:
+            self.finished = True
     
     def find_streak(self):
         """ Finds start i,j of four-in-a-row
@@ -133,29 +196,51 @@ class Game(object):
                     # check if a vertical four-in-a-row starts at (i, j)
                     if check_up(self.board, i, j, self.streak):
                         self.highlight_streak(i, j, 'vertical')
-                        self.winner = self.players[0] if self.players[0].color ==  self.board[i][j] else self.players[1]
+                        self.winner = self.players[0] if self.players[0].color == self.board[i][j].lower() else self.players[1]
                         self.finished = True
                         return
                     
                     # check if a horizontal four-in-a-row starts at (i, j)
                     if check_right(self.board, i, j, self.streak):
                         self.highlight_streak(i, j, 'horizontal')
-                        self.winner = self.players[0] if self.players[0].color ==  self.board[i][j] else self.players[1]
+                        self.winner = self.players[0] if self.players[0].color == self.board[i][j].lower() else self.players[1]
                         self.finished = True
                         return
                     
                     if check_diagonal_up(self.board, i, j, self.streak):
                         self.highlight_streak(i, j, 'diagonal_up')
-                        self.winner = self.players[0] if self.players[0].color ==  self.board[i][j] else self.players[1]
+                        self.winner = self.players[0] if self.players[0].color == self.board[i][j].lower() else self.players[1]
                         self.finished = True
                         return
 
                     if check_diagonal_down(self.board, i, j, self.streak):
                         self.highlight_streak(i, j, 'diagonal_down')
-                        self.winner = self.players[0] if self.players[0].color ==  self.board[i][j] else self.players[1]
+                        self.winner = self.players[0] if self.players[0].color == self.board[i][j].lower() else self.players[1]
                         self.finished = True
                         return
     
+    def find_streak_at(self, row, col):
+        """ Like find_streak, but only checks the lines through the piece at (row, col),
+            which is enough after every move because only that piece can make a streak
+        """
+        color = self.board[row][col].lower()
+        for direction, dr, dc in (('vertical', 1, 0), ('horizontal', 0, 1),
+                                  ('diagonal_up', 1, 1), ('diagonal_down', -1, 1)):
+            # walk back to the first piece of the line, then count forward
+            i, j = row, col
+            while 0 <= i-dr < self.height and 0 <= j-dc < self.width \
+                    and self.board[i-dr][j-dc].lower() == color:
+                i, j = i-dr, j-dc
+            length = 0
+            while 0 <= i + dr*length < self.height and 0 <= j + dc*length < self.width \
+                    and self.board[i + dr*length][j + dc*length].lower() == color:
+                length += 1
+            if length >= self.streak:
+                self.highlight_streak(i, j, direction)
+                self.winner = self.players[0] if self.players[0].color == color else self.players[1]
+                self.finished = True
+                return
+
     def highlight_streak(self, row, col, direction):
         """ This function enunciates four-in-a-rows by capitalizing
             the character for those pieces on the board
@@ -0,0 +1,179 @@
+import numpy as np
+import cfg
+
+HEIGHT = cfg.HEIGHT
+WIDTH = cfg.WIDTH
+STREAK = cfg.STREAK
+
+def winning_windows(width=WIDTH, height=HEIGHT, streak=STREAK):
+    """ All lines of 'streak' cells a player can complete to win.
+        Each window is a tuple of BitBoard bit indices (col*(height+1) + row).
+    """
+    windows = []
+    # vertical, horizontal, diagonal ↗, diagonal ↘ as (row, col) steps
+    for dr, dc in ((1, 0), (0, 1), (1, 1), (-1, 1)):
+        for row in range(height):
+            for col in range(width):
+                end_row = row + dr*(streak-1)
+                end_col = col + dc*(streak-1)
+                if not (0 <= end_row < height and end_col < width):
+                    continue
+                windows.append(tuple((col + dc*i)*(height+1) + row + dr*i for i in range(streak)))
+    return windows
+
+class WindowEvaluator(object):
+    """ Incremental version of the Minimax.value heuristic built on the winning windows.
+
+        For every window it keeps the number of pieces of each player, and for every
+        player hist[p][k] is the number of windows holding k of p's pieces and none of
+        the opponent's. play/undo touch only the windows through one cell, so value()
+        is a constant-time read of the histograms.
+        Unlike check_streak, a window counts pieces that need not be adjacent yet.
+    """
+
+    def __init__(self, width=WIDTH, height=HEIGHT, streak=STREAK):
+        self.width = width
+        self.height = height
+        self.streak = streak
+        self.windows = winning_windows(width, height, streak)
+        self.cell_windows = [[] for _ in range(width*(height+1))]
+        for w, window in enumerate(self.windows):
+            for index in window:
+                self.cell_windows[index].append(w)
+        self.reset()
+
+    def reset(self, bb=None):
+        """ Clear the counts, and load the pieces of BitBoard 'bb' if given
+        """
+        self.counts = [[0]*len(self.windows), [0]*len(self.windows)]
+        self.hist = [[0]*(self.streak+1), [0]*(self.streak+1)]
+        self.hist[0][0] = self.hist[1][0] = len(self.windows)
+        if bb is not None:
+            for p in range(2):
+                for index in range(len(self.cell_windows)):
+                    if bb.pieces[p] >> index & 1:
+                        self.play(index, p)
+
+    def play(self, index, p):
+        """ Player 'p' (0 for 'x', 1 for 'o') put a piece on bit 'index'
+        """
+        own, opp, hist, opp_hist = self.counts[p], self.counts[1-p], self.hist[p], self.hist[1-p]
+        for w in self.cell_windows[index]:
+            a = own[w]
+            b = opp[w]
+            if b == 0:
+                hist[a] -= 1
+                hist[a+1] += 1
+            if a == 0:
+                # the opponent can no longer complete this window
+                opp_hist[b] -= 1
+            own[w] = a + 1
+
+    def undo(self, index, p):
+        """ Inverse of play(index, p)
+        """
+        own, opp, hist, opp_hist = self.counts[p], self.counts[1-p], self.hist[p], self.hist[1-p]
+        for w in self.cell_windows[index]:
+            a = own[w] - 1
+            b = opp[w]
+            if b == 0:
+                hist[a+1] -= 1
+                hist[a] += 1
+            if a == 0:
+                opp_hist[b] += 1
+            own[w] = a
+
+    def value(self, color):
+        """ Same scale as Minimax.value: 100**(k-2) per open window with k pieces,
+            1e10 per completed window, and -1e7 if the opponent has completed one
+        """
+        p = 0 if color.lower() == 'x' else 1
+        hist, opp_hist = self.hist[p], self.hist[1-p]
+        if opp_hist[self.streak] != 0:
+            return -1e7
+        value = hist[self.streak]*1e10
+        for k in range(2, self.streak):
+            value += (hist[k] - opp_hist[k])*100**(k-2)
+        return value
+
+# board cell codes for the numpy batch api
+EMPTY, X, O = 0, 1, -1
+
+def boards_to_array(boards):
+    """ Convert a list of list-of-lists boards to an (N, H, W) int8 array
+        with 1 for 'x', -1 for 'o' and 0 for empty cells
+    """
+    chars = np.array(boards, dtype='<U1')
+    chars = np.char.lower(chars)
+    array = np.zeros(chars.shape, dtype=np.int8)
+    array[chars == 'x'] = X
+    array[chars == 'o'] = O
+    return array
+
+def keys_to_array(keys, width=WIDTH, height=HEIGHT):
+    """ Decode an array of BitBoard.key() codes to an (N, H, W) int8 array
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    array = np.zeros((len(keys), height, width), dtype=np.int8)
+    for col in range(width):
+        column = (keys >> col*(height+1)) & ((1 << height+1) - 1)
+        for row in range(height):
+            # a cell is filled if the column's end marker is above it
+            filled = (column >> row+1) != 0
+            array[:, row, col] = np.where(filled, np.where((column >> row) & 1, X, O), EMPTY)
+    return array
+
+def array_to_keys(boards):
+    """ Inverse of keys_to_array: BitBoard.key() codes of an (N, H, W) int8 array
+    """
+    boards = np.asarray(boards)
+    n, height, width = boards.shape
+    keys = np.zeros(n, dtype=np.int64)
+    heights = (boards != EMPTY).sum(axis=1)
+    for col in range(width):
+        offset = col*(height+1)
+        for row in range(height):
+            keys |= (boards[:, row, col] == X).astype(np.int64) << (offset + row)
+        # end marker of the column, see BitBoard.key
+        keys |= np.int64(1) << (offset + heights[:, col]).astype(np.int64)
+    return keys
+
+_window_masks = {}
+
+def window_masks(width=WIDTH, height=HEIGHT, streak=STREAK):
+    """ (num_windows, H*W) 0/1 matrix, row w selects the cells of winning window w
+    """
+    if (width, height, streak) not in _window_masks:
+        windows = winning_windows(width, height, streak)
+        masks = np.zeros((len(windows), height*width), dtype=np.int16)
+        for w, window in enumerate(windows):
+            for index in window:
+                col, row = divmod(index, height+1)
+                masks[w, row*width + col] = 1
+        _window_masks[(width, height, streak)] = masks
+    return _window_masks[(width, height, streak)]
+
+def batch_value(boards, color='x', streak=STREAK):
+    """ Score N boards at once with the WindowEvaluator heuristic.
+
+        boards: (N, H, W) int8 array as made by boards_to_array
+        Returns (values, wins, losses): float64 heuristic values from the point of view
+        of 'color', and bool arrays telling whether 'color' or its opponent has a streak.
+    """
+    boards = np.asarray(boards)
+    n, height, width = boards.shape
+    masks = window_masks(width, height, streak)
+    sign = X if color.lower() == 'x' else O
+    flat = boards.reshape(n, -1)
+    # pieces of each player in every window, shape (N, num_windows)
+    own = (flat == sign).astype(np.int16) @ masks.T
+    opp = (flat == -sign).astype(np.int16) @ masks.T
+
+    wins = (own == streak).any(axis=1)
+    losses = (opp == streak).any(axis=1)
+    values = (own == streak).sum(axis=1)*1e10
+    for k in range(2, streak):
+        values = values + (((own == k) & (opp == 0)).sum(axis=1)
+                           - ((opp == k) & (own == 0)).sum(axis=1))*100.0**(k-2)
+    values = np.where(losses, -1e7, values)
+    return values, wins, losses
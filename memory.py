@@ -5,32 +5,125 @@ from collections import namedtuple
 Transition = namedtuple('Transition', 
                         ('state', 'action', 'next_state', 'reward', 'done'))
 
-class ReplayBuffer(object):
+class SumTree(object):
+    """ Binary tree of priorities where every node holds the sum of its children.
 
-    def __init__(self, capacity, seed,
-                 priority_weight=None, priority_exponent=None,
-                 priotirized_experience=False):
-        self.capacity = capacity
-        self.position = 0
+        Leaves sit at tree[size + i] for buffer index i, with size the smallest power of
+        two >= capacity, and the root at tree[1]. Updates and lookups walk one root-leaf
+        path, O(log N), and are vectorized over a batch of indices.
+    """
+
+    def __init__(self, capacity):
+        self.size = 1
+        while self.size < capacity:
+            self.size *= 2
+        self.depth = self.size.bit_length() - 1
+        self.tree = np.zeros(2*self.size, dtype=np.float64)
+
+    def total(self):
+        return self.tree[1]
+
+    def get(self, index):
+        return self.tree[self.size + np.asarray(index)]
+
+    def update(self, index, priority):
+        """ Set the priorities of the leaves 'index' and refresh their ancestors
+        """
+        node = self.size + np.asarray(index).ravel()
+        self.tree[node] = priority
+        for _ in range(self.depth):
+            node = np.unique(node // 2)
+            self.tree[node] = self.tree[2*node] + self.tree[2*node + 1]
+
+    def find(self, value):
+        """ Leaf indices whose cumulative priority range contains each 'value'
+        """
+        value = np.array(value, dtype=np.float64)
+        node = np.ones(len(value), dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2*node
+            go_right = value > self.tree[left]
+            value -= np.where(go_right, self.tree[left], 0)
+            node = left + go_right
+        return node - self.size
+
+    def sample(self, batch_size, num_filled, priority_weight, rng):
+        """ Stratified sample of batch_size indices proportional to priority.
+            Returns (indices, importance sampling weights normalized to max 1).
+        """
+        batch_size = int(batch_size)
+        segment = self.total() / batch_size
+        value = (np.arange(batch_size) + rng.random(batch_size)) * segment
+        index = np.minimum(self.find(value), num_filled - 1)
+        probs = self.get(index) / self.total()
+        weights = (num_filled * probs) ** -priority_weight
+        return index, weights / weights.max()
+
+class PrioritizedReplay(object):
+    """ Prioritized experience replay shared by ReplayBuffer and ArrayReplayBuffer.
+        Subclasses call init_priorities in __init__, push_priority for every new
+        transition and sample_priorities instead of sampling uniformly.
+    """
+
+    def init_priorities(self, capacity, priority_weight, priority_exponent,
+                        priotirized_experience, priority_weight_increase):
         self.prioritize = priotirized_experience
         self.priority_weight = priority_weight  # Initial importance sampling weight β, annealed to 1 over course of training
         self.priority_exponent = priority_exponent
+        self.priority_weight_increase = priority_weight_increase # added to β after every sample
         if self.prioritize:
-            self.memory = []
-        else:
-            self.memory = []
+            self.tree = SumTree(int(capacity))
+            self.max_priority = 1.0
+
+    def push_priority(self, index):
+        if self.prioritize:
+            # new transitions are sampled at least once with the highest priority
+            self.tree.update(index, self.max_priority ** self.priority_exponent)
+
+    def sample_priorities(self, batch_size, num_filled):
+        """ (indices, importance sampling weights) of a prioritized sample, anneals β
+        """
+        index, weights = self.tree.sample(batch_size, num_filled, self.priority_weight, self.rng)
+        self.priority_weight = min(self.priority_weight + self.priority_weight_increase, 1)
+        return index, weights
+
+    def update_priorities(self, index, priorities):
+        """ Write back new priorities (e.g. absolute TD errors) for sampled indices
+        """
+        priorities = np.asarray(priorities, dtype=np.float64) + 1e-6
+        self.max_priority = max(self.max_priority, priorities.max())
+        self.tree.update(index, priorities ** self.priority_exponent)
+
+class ReplayBuffer(PrioritizedReplay):
+
+    def __init__(self, capacity, seed,
+                 priority_weight=None, priority_exponent=None,
+                 priotirized_experience=False, priority_weight_increase=0):
+        self.capacity = capacity
+        self.position = 0
+        self.init_priorities(capacity, priority_weight, priority_exponent,
+                             priotirized_experience, priority_weight_increase)
+        self.memory = []
         # Seed for reproducible results
         np.random.seed(seed)
+        self.rng = np.random.default_rng(seed)
 
     def push(self, *args):
         """Saves a transition."""
         if len(self.memory) < self.capacity:
             self.memory.append(None)
         self.memory[self.position] = Transition(*args)
+        self.push_priority(self.position)
         self.position = int((self.position + 1) % self.capacity)
 #        print(f'{self.position = }, {self.memory[-1] = }')
 
     def sample_batch(self, batch_size):
+        """ Uniform: list of Transitions.
+            Prioritized: (list of Transitions, indices, importance sampling weights).
+        """
+        if self.prioritize:
+            index, weights = self.sample_priorities(batch_size, len(self.memory))
+            return [self.memory[i] for i in index], index, weights
         return random.sample(self.memory, int(batch_size))
 
     def __len__(self):
@@ -39,6 +132,63 @@ class ReplayBuffer(object):
     def get_buffer_size(self):
         return len(self.memory)
 
+class ArrayReplayBuffer(PrioritizedReplay):
+    """ ReplayBuffer with a structure-of-arrays backend.
+
+        Transitions are written into preallocated NumPy arrays with wraparound, so states
+        must be integer codes (see BitBoard.key). sample_batch returns one Transition whose
+        fields are arrays of length batch_size instead of a list of Transitions.
+    """
+
+    def __init__(self, capacity, seed,
+                 priority_weight=None, priority_exponent=None,
+                 priotirized_experience=False, priority_weight_increase=0):
+        self.capacity = int(capacity)
+        self.position = 0
+        self.size = 0
+        self.init_priorities(self.capacity, priority_weight, priority_exponent,
+                             priotirized_experience, priority_weight_increase)
+        self.state = np.zeros(self.capacity, dtype=np.int64)
+        self.action = np.zeros(self.capacity, dtype=np.int8)
+        self.next_state = np.zeros(self.capacity, dtype=np.int64)
+        self.reward = np.zeros(self.capacity, dtype=np.float64)
+        self.done = np.zeros(self.capacity, dtype=bool)
+        # Seed for reproducible results
+        np.random.seed(seed)
+        self.rng = np.random.default_rng(seed)
+
+    def push(self, state, action, next_state, reward, done):
+        """Saves a transition."""
+        i = self.position
+        self.state[i] = state
+        self.action[i] = action
+        self.next_state[i] = next_state
+        self.reward[i] = reward
+        self.done[i] = done
+        self.push_priority(i)
+        self.position = (self.position + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def sample_batch(self, batch_size):
+        """ Uniform: Transition of arrays.
+            Prioritized: (Transition of arrays, indices, importance sampling weights).
+        """
+        if self.prioritize:
+            index, weights = self.sample_priorities(batch_size, self.size)
+        else:
+            index = self.rng.choice(self.size, int(batch_size), replace=False)
+        batch = Transition(self.state[index], self.action[index], self.next_state[index],
+                           self.reward[index], self.done[index])
+        if self.prioritize:
+            return batch, index, weights
+        return batch
+
+    def __len__(self):
+        return self.size
+
+    def get_buffer_size(self):
+        return self.size
+
 def main():
     test_buffer = ReplayBuffer(1000, 3)
 
@@ -0,0 +1,164 @@
+import bisect
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# Instrumentation is off unless enable() is called. Hot paths test this flag before
+# doing any work, so the cost when disabled is one attribute lookup per hook:
+#
+#     start = time.perf_counter() if metrics.enabled else 0
+#     ...
+#     if metrics.enabled:
+#         metrics.observe('search_seconds', time.perf_counter() - start)
+enabled = False
+
+# upper bounds in seconds, from a fast leaf evaluation to a deep search
+TIME_BUCKETS = (1e-5, 1e-4, 3e-4, 1e-3, 3e-3, 1e-2, 3e-2, 0.1, 0.3, 1.0, 3.0, 10.0)
+
+_counters = {}
+_gauges = {}
+_histograms = {}
+_lock = threading.Lock()
+
+class Histogram(object):
+    """ Counts of observations per bucket, with the bucket upper bounds in 'buckets'
+        and a last, unbounded bucket
+    """
+
+    def __init__(self, buckets=TIME_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0]*(len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+def enable():
+    global enabled
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+def reset():
+    """ Forget every metric
+    """
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+
+def inc(name, amount=1):
+    """ Add 'amount' to counter 'name'
+    """
+    _counters[name] = _counters.get(name, 0) + amount
+
+def set_gauge(name, value):
+    _gauges[name] = value
+
+def observe(name, value, buckets=TIME_BUCKETS):
+    """ Add 'value' to histogram 'name', created with 'buckets' on first use
+    """
+    histogram = _histograms.get(name)
+    if histogram is None:
+        histogram = _histograms[name] = Histogram(buckets)
+    histogram.observe(value)
+
+def snapshot():
+    """ Copy of every metric as plain dicts, for JSON
+    """
+    with _lock:
+        return {
+            'counters': dict(_counters),
+            'gauges': dict(_gauges),
+            'histograms': {name: {'buckets': list(h.buckets), 'counts': list(h.counts),
+                                  'sum': h.sum, 'count': h.count}
+                           for name, h in _histograms.items()},
+        }
+
+def prometheus_text(prefix='connect4_'):
+    """ Every metric in the Prometheus text exposition format
+    """
+    lines = []
+    with _lock:
+        for name, value in sorted(_counters.items()):
+            lines.append(f'# TYPE {prefix}{name} counter')
+            lines.append(f'{prefix}{name} {value}')
+        for name, value in sorted(_gauges.items()):
+            lines.append(f'# TYPE {prefix}{name} gauge')
+            lines.append(f'{prefix}{name} {value}')
+        for name, h in sorted(_histograms.items()):
+            lines.append(f'# TYPE {prefix}{name} histogram')
+            cumulative = 0
+            for bound, count in zip(h.buckets, h.counts):
+                cumulative += count
+                lines.append(f'{prefix}{name}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f'{prefix}{name}_bucket{{le="+Inf"}} {h.count}')
+            lines.append(f'{prefix}{name}_sum {h.sum}')
+            lines.append(f'{prefix}{name}_count {h.count}')
+    return '\n'.join(lines) + '\n'
+
+class StatsWriter(object):
+    """ Appends a JSON line with every metric to 'path' at most every 'interval'
+        seconds, with the per-second rate of every counter since the previous line
+        (e.g. games_total gives games per second)
+    """
+
+    def __init__(self, path, interval=60):
+        self.path = path
+        self.interval = interval
+        self.last_time = time.time()
+        self.last_counters = {}
+
+    def maybe_write(self):
+        """ Write a line if 'interval' seconds have passed, cheap to call every game
+        """
+        now = time.time()
+        if now - self.last_time >= self.interval:
+            self.write(now)
+
+    def write(self, now=None):
+        now = time.time() if now is None else now
+        stats = snapshot()
+        elapsed = max(now - self.last_time, 1e-9)
+        stats['rates'] = {name: (value - self.last_counters.get(name, 0)) / elapsed
+                          for name, value in stats['counters'].items()}
+        stats['time'] = now
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(stats) + '\n')
+        self.last_time = now
+        self.last_counters = stats['counters']
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = prometheus_text().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(port, host=''):
+    """ Serve prometheus_text() over HTTP on 'port' from a daemon thread
+    """
+    server = HTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+def write_prometheus(path):
+    """ Write prometheus_text() atomically, e.g. for the node exporter's textfile collector
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(prometheus_text())
+    os.replace(tmp, path)
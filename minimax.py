@@ -8,26 +8,68 @@
 # February 27, 2012
 
 import random
+import time
 import cfg
 from board import *
+from bitboard import BitBoard
+from transposition import TranspositionTable, EXACT, LOWER, UPPER
+from evaluate import WindowEvaluator
+from solver import Solver
+from ordering import MoveOrdering
 
 STREAK = cfg.STREAK
+TT_MEMORY = cfg.TT_MEMORY
+# nodes between two clock reads of a timed search; a check_streak leaf takes ~80 us
+DEADLINE_CHECK_NODES = 16
+SOLVED_SCALE = 1e10 # Minimax value of a solver score of (cells+1)//2, i.e. the quickest win
+
+class SearchTimeout(Exception):
+    """ Raised inside the search when the deadline of iterative_search has passed
+    """
+    pass
 
 class Minimax(object):
     """ Minimax object that takes a current connect four board state
     """
     
-    def __init__(self, color, num_streak=STREAK):
+    def __init__(self, color, num_streak=STREAK, tt_memory=TT_MEMORY, incremental_eval=False,
+                 symmetric_tt=False, endgame_threshold=0, ordering=None, seed=None):
         # copy the board to self.board
         #self.board = [x[:] for x in board]
         self.color = color
         self.num_streak = num_streak
+        self.nodes = 0 # number of nodes visited by the last search
+        self.deadline = None # time.time() after which an iterative search gives up
+        self.depth_reached = 0 # deepest completed iteration of the last iterative search
+        # transposition table kept for the lifetime of this object, tt_memory in bytes
+        self.tt = TranspositionTable(tt_memory) if tt_memory else None
+        # search() and iterative_search() score leaves with WindowEvaluator instead of value()
+        self.evaluator = None
+        if incremental_eval:
+            self.evaluator = WindowEvaluator(cfg.WIDTH, cfg.HEIGHT, num_streak)
+        # share transposition entries between a position and its mirror image.
+        # Only exact with a mirror-symmetric evaluation: WindowEvaluator is, check_streak is not.
+        self.symmetric_tt = symmetric_tt
+        # with at most endgame_threshold empty cells, search() and iterative_search()
+        # solve the position exactly; the solver keeps its cache between calls
+        self.endgame_threshold = endgame_threshold
+        self.solver = Solver() if endgame_threshold > 0 else None
+        # move ordering of search() and iterative_search(), see ordering.py
+        self.ordering = ordering if ordering is not None else MoveOrdering(cfg.WIDTH)
+        # tie-break between equally good moves, taken in column order so that a seed
+        # makes searches reproducible whatever order the moves were searched in
+        self.rng = random.Random(seed)
             
     def best_move(self, depth, state, color):
         """ 
             In current board "state", player in "color" foresees "depth" step further
             and gets the best action
         """
+        self.nodes = 0
+        return self._minimax(depth, state, color)
+
+    def _minimax(self, depth, state, color):
+        self.nodes += 1
         opp_color = 'x' if color == 'o' else 'o'
 
         # enumerate all legal moves
@@ -41,15 +83,241 @@ class Minimax(object):
         move_value = {}
         for move in legal_moves:
             next_board = calc_next_board(state, move, color)
-            _, v = self.best_move(depth-1, next_board, opp_color)
+            _, v = self._minimax(depth-1, next_board, opp_color)
             move_value[move] = v
 
         max_or_min = max if self.color==color else min # determine whether this player is maximizer or minimizer
         opt_value = max_or_min(move_value.values())
         tie = [move for move in legal_moves if move_value[move] == opt_value]
-        opt_move = random.choice(tie)
+        opt_move = self.rng.choice(tie)
         
         return opt_move, opt_value
+
+    def search(self, depth, state, color):
+        """ 
+            Same as best_move, but with alpha-beta pruning and principal variation search
+            on a BitBoard. It returns the same value as best_move and picks at random
+            among the same tied moves, while visiting far fewer nodes (see self.nodes).
+        """
+        self.nodes = 1
+        if self.tt is not None:
+            self.tt.new_search()
+        self.ordering.new_search()
+        bb = BitBoard.from_board(state, self.num_streak)
+        if self.evaluator is not None:
+            self.evaluator.reset(bb)
+
+        legal_moves = bb.legal_moves()
+        if depth == 0 or len(legal_moves) == 0:
+            return None, self.leaf_value(bb, color)
+        if self.is_endgame(bb):
+            return self.solve(bb, color)
+
+        tie, opt_value = self._root(depth, bb, color, self.ordering.order(legal_moves, 0, color))
+        opt_move = self.rng.choice(sorted(tie))
+
+        return opt_move, opt_value
+
+    def search_value(self, depth, state, color):
+        """ Alpha-beta value of "state" with "color" to move, searched "depth" steps.
+            Used to search root moves separately, e.g. in other processes.
+        """
+        self.nodes = 0
+        if self.tt is not None:
+            self.tt.new_search()
+        self.ordering.new_search()
+        bb = BitBoard.from_board(state, self.num_streak)
+        if self.evaluator is not None:
+            self.evaluator.reset(bb)
+        return self._alphabeta(depth, bb, color, -float('inf'), float('inf'))
+
+    def iterative_search(self, time_limit, state, color, max_depth=None):
+        """ 
+            Search depth 1, 2, 3... until "time_limit" milliseconds have passed and
+            return the best move of the deepest completed iteration. The tied best moves
+            of each iteration are searched first in the next one.
+        """
+        self.nodes = 1
+        self.depth_reached = 0
+        if self.tt is not None:
+            self.tt.new_search()
+        self.ordering.new_search()
+        bb = BitBoard.from_board(state, self.num_streak)
+        if self.evaluator is not None:
+            self.evaluator.reset(bb)
+
+        legal_moves = bb.legal_moves()
+        if len(legal_moves) == 0:
+            return None, self.leaf_value(bb, color)
+        if self.is_endgame(bb):
+            return self.solve(bb, color)
+        if max_depth is None:
+            max_depth = self.num_empty(bb)
+
+        deadline = time.time() + time_limit/1000
+        tie, opt_value = self.ordering.order(legal_moves, 0, color), None
+        for depth in range(1, max_depth+1):
+            # depth 1 always completes, so there is a move to return
+            self.deadline = deadline if depth > 1 else None
+            ordered = tie + [move for move in legal_moves if move not in tie]
+            try:
+                tie, opt_value = self._root(depth, bb, color, ordered)
+            except SearchTimeout:
+                # bb is left mid-search, but it is not used again
+                break
+            finally:
+                self.deadline = None
+            self.depth_reached = depth
+            if time.time() >= deadline:
+                break
+        opt_move = self.rng.choice(sorted(tie))
+
+        return opt_move, opt_value
+
+    def num_empty(self, bb):
+        return bb.width*bb.height - bb.num_pieces()
+
+    def is_endgame(self, bb):
+        return self.solver is not None and self.num_empty(bb) <= self.endgame_threshold \
+            and not bb.is_win('x') and not bb.is_win('o')
+
+    def solve(self, bb, color):
+        """ Exact best move with its solver score (win sooner, lose later) scaled by
+            SOLVED_SCALE and signed for self.color like every other Minimax value.
+            A score can only reach (cells+1)//2 on the empty board, so solved values
+            of endgames stay below SOLVED_SCALE, the reward of a finished win.
+        """
+        tie, score = self.solver.best_moves(bb, color)
+        self.nodes = self.solver.nodes
+        value = score*SOLVED_SCALE / ((bb.width*bb.height + 1)//2)
+        if color != self.color:
+            value = -value
+        return self.rng.choice(sorted(tie)), value
+
+    def leaf_value(self, bb, color):
+        if self.evaluator is not None:
+            return self.evaluator.value(color)
+        return self.value(bb.to_board(), color)
+
+    def _play(self, bb, move, color):
+        if self.evaluator is not None:
+            self.evaluator.play(move*(bb.height+1) + bb.heights[move], 0 if color == 'x' else 1)
+        bb.play(move, color)
+
+    def _undo(self, bb):
+        move, p = bb.moves[-1]
+        bb.undo()
+        if self.evaluator is not None:
+            self.evaluator.undo(move*(bb.height+1) + bb.heights[move], p)
+
+    def _root(self, depth, bb, color, legal_moves):
+        """ Search every root move in the given order, return (tied best moves, value)
+        """
+        opp_color = 'x' if color == 'o' else 'o'
+        maximize = self.color == color
+        opt_value = None
+        tie = []
+        for move in legal_moves:
+            if self.deadline is not None and time.time() > self.deadline:
+                raise SearchTimeout
+            # values are integral, so a window one unit around the best value so far
+            # still tells exact ties apart from worse moves
+            if opt_value is None:
+                alpha, beta = -float('inf'), float('inf')
+            elif maximize:
+                alpha, beta = opt_value - 1, float('inf')
+            else:
+                alpha, beta = -float('inf'), opt_value + 1
+            self._play(bb, move, color)
+            v = self._alphabeta(depth-1, bb, opp_color, alpha, beta)
+            self._undo(bb)
+
+            if opt_value is None or (v > opt_value if maximize else v < opt_value):
+                opt_value = v
+                tie = [move]
+            elif v == opt_value:
+                tie.append(move)
+
+        return tie, opt_value
+
+    def _alphabeta(self, depth, bb, color, alpha, beta):
+        """ Fail-soft alpha-beta with null-window searches for all but the first child
+
+            The heuristic is taken from the point of view of the side to move at the leaf,
+            so values searched to different depths are not comparable. Transposition
+            entries only give cutoffs at the same depth; others just order the moves.
+        """
+        self.nodes += 1
+        if self.deadline is not None and self.nodes % DEADLINE_CHECK_NODES == 0 \
+                and time.time() > self.deadline:
+            raise SearchTimeout
+        legal_moves = bb.legal_moves()
+        if depth == 0 or len(legal_moves) == 0:
+            return self.leaf_value(bb, color)
+
+        tt_move = None
+        if self.tt is not None:
+            if self.symmetric_tt:
+                key, flipped = bb.canonical_search_hash(color)
+            else:
+                key, flipped = bb.search_hash(color), False
+            entry = self.tt.probe(key)
+            if entry is not None:
+                tt_depth, flag, tt_value, tt_move = entry
+                if flipped:
+                    tt_move = bb.mirror_move(tt_move)
+                if tt_depth == depth:
+                    if flag == EXACT:
+                        return tt_value
+                    elif flag == LOWER and tt_value >= beta:
+                        return tt_value
+                    elif flag == UPPER and tt_value <= alpha:
+                        return tt_value
+            alpha_orig, beta_orig = alpha, beta
+        # the stored best move first, then killers, history and center
+        ply = len(bb.moves)
+        legal_moves = self.ordering.order(legal_moves, ply, color, tt_move)
+
+        opp_color = 'x' if color == 'o' else 'o'
+        maximize = self.color == color
+        opt_value = -float('inf') if maximize else float('inf')
+        opt_move = legal_moves[0]
+        for i, move in enumerate(legal_moves):
+            self._play(bb, move, color)
+            if i == 0:
+                v = self._alphabeta(depth-1, bb, opp_color, alpha, beta)
+            elif maximize:
+                v = self._alphabeta(depth-1, bb, opp_color, alpha, alpha+1)
+                if alpha < v < beta:
+                    v = self._alphabeta(depth-1, bb, opp_color, alpha, beta)
+            else:
+                v = self._alphabeta(depth-1, bb, opp_color, beta-1, beta)
+                if alpha < v < beta:
+                    v = self._alphabeta(depth-1, bb, opp_color, alpha, beta)
+            self._undo(bb)
+
+            if maximize:
+                if v > opt_value:
+                    opt_value, opt_move = v, move
+                alpha = max(alpha, v)
+            else:
+                if v < opt_value:
+                    opt_value, opt_move = v, move
+                beta = min(beta, v)
+            if alpha >= beta:
+                self.ordering.cutoff(move, ply, depth, color)
+                break
+
+        if self.tt is not None:
+            if opt_value <= alpha_orig:
+                flag = UPPER
+            elif opt_value >= beta_orig:
+                flag = LOWER
+            else:
+                flag = EXACT
+            self.tt.store(key, depth, flag, opt_value, bb.mirror_move(opt_move) if flipped else opt_move)
+
+        return opt_value
         
     def value(self, state, color):
         """ Simple heuristic to evaluate board configurations
@@ -0,0 +1,55 @@
+class MoveOrdering(object):
+    """ Orders the moves of a search node, best candidates first.
+
+        center  : static order, columns closer to the center first
+        killers : the last two moves per ply that caused a cutoff
+        history : moves scored by depth**2 every time they cause a cutoff
+        A transposition table move, if any, always goes first.
+    """
+
+    def __init__(self, width, center=True, killers=True, history=True):
+        self.width = width
+        self.center = center
+        self.killers = killers
+        self.history = history
+        self.center_rank = [abs(col - (width-1)/2) for col in range(width)]
+        self.killer_moves = {}
+        self.history_table = {'x': [0]*width, 'o': [0]*width}
+
+    def new_search(self):
+        """ Forget the killers, and age the history so recent searches weigh more
+        """
+        self.killer_moves = {}
+        for color in self.history_table:
+            self.history_table[color] = [h // 2 for h in self.history_table[color]]
+
+    def order(self, legal_moves, ply, color, tt_move=None):
+        moves = list(legal_moves)
+        if self.history:
+            history = self.history_table[color]
+            if self.center:
+                moves.sort(key=lambda col: (-history[col], self.center_rank[col]))
+            else:
+                moves.sort(key=lambda col: -history[col])
+        elif self.center:
+            moves.sort(key=lambda col: self.center_rank[col])
+        if self.killers:
+            for killer in reversed(self.killer_moves.get(ply, ())):
+                if killer in moves:
+                    moves.remove(killer)
+                    moves.insert(0, killer)
+        if tt_move is not None and tt_move in moves:
+            moves.remove(tt_move)
+            moves.insert(0, tt_move)
+        return moves
+
+    def cutoff(self, move, ply, depth, color):
+        """ Record that 'move' caused a cutoff 'depth' plies from the leaves
+        """
+        if self.killers:
+            killers = self.killer_moves.setdefault(ply, [])
+            if move not in killers:
+                killers.insert(0, move)
+                del killers[2:]
+        if self.history:
+            self.history_table[color][move] += depth*depth
@@ -0,0 +1,70 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from bitboard import BitBoard
+from board import calc_next_board
+from minimax import Minimax
+
+# Minimax of a worker process, kept between searches so its transposition table is reused
+_worker_minimax = None
+
+def _init_worker(color, minimax_kwargs):
+    global _worker_minimax
+    _worker_minimax = Minimax(color, **minimax_kwargs)
+
+def _search_child(depth, state, color):
+    value = _worker_minimax.search_value(depth, state, color)
+    return value, _worker_minimax.nodes
+
+class ParallelSearch(object):
+    """ Root-split version of Minimax.search over a process pool.
+
+        Every root move is searched with a full window in a worker, so the values, and
+        with them the tied best moves, are exactly those of the serial search. Workers
+        keep their own transposition table across searches; Python objects cannot be
+        shared between processes cheaply, so the tables are per worker.
+    """
+
+    def __init__(self, color, workers=None, seed=None, **minimax_kwargs):
+        self.color = color
+        self.workers = workers or os.cpu_count()
+        self.minimax_kwargs = minimax_kwargs
+        # the local Minimax handles depth 0 and endgames, which are not split
+        self.minimax = Minimax(color, seed=seed, **minimax_kwargs)
+        # one random stream for both paths, as in a serial Minimax with the same seed
+        self.rng = self.minimax.rng
+        self.pool = None
+        self.nodes = 0
+
+    def search(self, depth, state, color):
+        """ Same (move, value) as Minimax.search(depth, state, color)
+        """
+        bb = BitBoard.from_board(state, self.minimax.num_streak)
+        legal_moves = bb.legal_moves()
+        if depth <= 1 or len(legal_moves) <= 1 or self.minimax.is_endgame(bb):
+            result = self.minimax.search(depth, state, color)
+            self.nodes = self.minimax.nodes
+            return result
+
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(self.workers, initializer=_init_worker,
+                                            initargs=(self.color, self.minimax_kwargs))
+        opp_color = 'x' if color == 'o' else 'o'
+        futures = {move: self.pool.submit(_search_child, depth-1,
+                                          calc_next_board(state, move, color), opp_color)
+                   for move in legal_moves}
+
+        self.nodes = 1
+        move_value = {}
+        for move, future in futures.items():
+            move_value[move], nodes = future.result()
+            self.nodes += nodes
+
+        max_or_min = max if self.color == color else min
+        opt_value = max_or_min(move_value.values())
+        tie = [move for move in legal_moves if move_value[move] == opt_value]
+        return self.rng.choice(tie), opt_value
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
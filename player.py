@@ -1,10 +1,18 @@
 import cfg
+import sys
+import time
+import random
+import metrics
 from minimax import Minimax
+from parallel import ParallelSearch
 import numpy as np
 import copy
-import pickle
-from memory import ReplayBuffer
+from memory import ArrayReplayBuffer
 from board import *
+from bitboard import BitBoard
+from qtable import QTable, FrozenQTable
+from checkpoint import write_checkpoint, CheckpointReader
+from evaluate import batch_value, keys_to_array, array_to_keys
 
 WIDTH = cfg.WIDTH
 HEIGHT = cfg.HEIGHT
@@ -21,6 +29,9 @@ class Player:
     def move(self, board):
         return 0
 
+    def close(self):
+        pass
+
 class HumanPlayer(Player):
     """ Player object.  This class is for human players.
     """
@@ -55,11 +66,15 @@ class QPlayer(Player):
     type = None # possible types are "Human" and "AI"
     name = None
     color = None
-    Q = None # Q function dictionary. Q = {}, 
-             # Q[board] = np.array with size self.available_actions(board)
+    Q = None # Q function table (see qtable.py), keyed by BitBoard codes.
+             # Q.values[Q.find(state)] = Q value per column, -inf for full columns
     def __init__(self, name, color, discount_factor = 0.99,
                  streak = STREAK, height = HEIGHT, width = WIDTH, 
-                 epsilon = 0.1, epsilon_min = 0.01, epsilon_decay=0.995, batch_size=1e3):
+                 epsilon = 0.1, epsilon_min = 0.01, epsilon_decay=0.995, batch_size=1e3,
+                 prioritized = False, priority_exponent = 0.6, priority_weight = 0.4,
+                 priority_weight_increase = 1e-3, symmetric = True,
+                 reward_shaping = 'minimax', shaping_cache_size = 1e6, book = None,
+                 endgame_threshold = 0):
         self.type = "QPlayer"
         self.name = name
         self.color = color
@@ -70,14 +85,33 @@ class QPlayer(Player):
         self.epsilon_min = epsilon_min
         self.epsilon_decay = epsilon_decay
         self.epsilon = epsilon
-        self.Q = {}
-        self.count = {}
+        self.Q = QTable(width, height)
+        # key states by the canonical orientation of the board, so a position and
+        # its mirror image share one Q row (actions are mirrored to match)
+        self.symmetric = symmetric
+        self.checkpoints = set() # checkpoint paths this Q table was loaded from or saved to
+        self.readonly = False # set by load_readonly, move() then only picks actions
+        self.book = book # OpeningBook consulted before the Q table
         self.discount_factor = discount_factor
 
-        self.buffer = ReplayBuffer(1e5, 1)
+        # prioritized: sample transitions by TD error, weights annealed from priority_weight to 1
+        self.buffer = ArrayReplayBuffer(1e5, 1, priority_weight, priority_exponent,
+                                        prioritized, priority_weight_increase)
         self.batch_size = batch_size
         self.transition_counter = 0
 
+        # how non-terminal moves are rewarded, see calc_reward:
+        #   'minimax'  : depth-2 minimax search after every move
+        #   'cached'   : same, memoized by the position after the move (not its mirror
+        #                class, the depth-2 search scores mirrored positions differently)
+        #   'deferred' : static evaluation of the whole batch at once in update()
+        #   None       : no shaping, terminal rewards only
+        self.reward_shaping = reward_shaping
+        # endgame_threshold > 0 gives exact shaping rewards near the end of the game
+        self.shaping_minimax = Minimax(self.opp_color, endgame_threshold=endgame_threshold)
+        self.shaping_cache = {}
+        self.shaping_cache_size = shaping_cache_size
+
         self.sum_reward = 0
 
     def reset(self):
@@ -86,63 +120,117 @@ class QPlayer(Player):
     def __str__(self):
         return "Q learning player"
 
-    def save(self):
-        with open('data/Q.pkl', 'wb') as f:
-            pickle.dump(self.Q, f)
-        with open('data/epsilon.pkl', 'wb') as f:
-            pickle.dump(self.epsilon, f)
+    def save(self, path='data/Q'):
+        """ Append the Q rows changed since the last save to the checkpoint at 'path'.
+            The first save to a path this player did not load from replaces its contents.
+        """
+        write_checkpoint(path, self.Q, self.epsilon, reset=path not in self.checkpoints)
+        self.checkpoints.add(path)
 
-    def load(self):
-        with open('data/Q.pkl', 'rb') as f:
-            self.Q = pickle.load(f)
-        with open('data/epsilon.pkl', 'rb') as f:
-            self.epsilon = pickle.load(f)
+    def load(self, path='data/Q'):
+        """ Open the checkpoint at 'path'. Rows are read lazily when a state is first seen.
+        """
+        backing = CheckpointReader(path)
+        self.Q = QTable(self.width, self.height, backing=backing)
+        self.checkpoints.add(path)
+        if backing.epsilon is not None:
+            self.epsilon = backing.epsilon
+
+    def load_readonly(self, path='data/Q-serve'):
+        """ Serve a Q table exported with checkpoint.export. It is memory-mapped and
+            never updated, and move() skips rewards and the replay buffer.
+        """
+        self.Q = FrozenQTable(path)
+        self.readonly = True
 
     def move(self, board):
         action = self._move(board)
-        reward = self.calc_reward(board, action)
-        self.sum_reward += reward
-        done, result = self.calc_done(board, action)
+        if self.readonly:
+            return action
+        # the next board and the terminal check are shared by reward and done
         next_board = calc_next_board(board, action, self.color)
+        done, result = self.calc_done(board, action, next_board)
+        start = time.perf_counter() if metrics.enabled else 0
+        reward = self.calc_reward(board, action, next_board, (done, result))
+        if metrics.enabled:
+            metrics.observe('calc_reward_seconds', time.perf_counter() - start)
+        self.sum_reward += reward
         # board is list, so it is unhashable
-        # tuple is hashable
-        state = self._get_key_from_board(board)
-        next_state = self._get_key_from_board(next_board)
+        # states are stored as integer BitBoard codes
+        state, flipped = self._get_key_from_board(board)
+        next_state, _ = self._get_key_from_board(next_board)
+        if flipped:
+            action = self.width-1 - action
 
         #Todo: define transition
         #Todo: seperate update and move
         self.buffer.push(state,action,next_state,reward,done)
         self.transition_counter += 1
+        if flipped:
+            action = self.width-1 - action
         return action
 
-    def calc_reward(self, board, action):
-        done, result = self.calc_done(board, action)
-        if done and result == 'winner':
+    def calc_reward(self, board, action, next_board=None, done_result=None):
+        """
+        next_board and done_result (the output of calc_done) are computed here
+        if the caller does not pass them.
+        """
+        if next_board is None:
+            next_board = calc_next_board(board, action, self.color)
+        done, result = done_result if done_result is not None else self.calc_done(board, action, next_board)
+        if done and result == 'win':
             return 1e10
-        elif done and result == 'loser':
+        elif done and result == 'lose':
             return -1e10
         elif done and result =='tie':
             return -1e3
 
-        m = Minimax(self.opp_color)
-        next_board = calc_next_board(board, action, self.color)
-        opp_best_move, opp_value = m.best_move(2, next_board, self.opp_color)
+        if self.reward_shaping == 'minimax':
+            opp_best_move, opp_value = self.shaping_minimax.search(2, next_board, self.opp_color)
+            return -opp_value
+        elif self.reward_shaping == 'cached':
+            bb = BitBoard.from_board(next_board, self.streak)
+            # a mirror and its position only share an entry when the evaluation is
+            # mirror-symmetric: WindowEvaluator is, check_streak is not
+            if self.shaping_minimax.evaluator is not None:
+                key, _ = bb.canonical_key()
+            else:
+                key = bb.key()
+            if metrics.enabled:
+                metrics.inc('shaping_cache_lookups_total')
+            if key not in self.shaping_cache:
+                if metrics.enabled:
+                    metrics.inc('shaping_cache_misses_total')
+                if len(self.shaping_cache) >= self.shaping_cache_size:
+                    self.shaping_cache.clear()
+                opp_best_move, opp_value = self.shaping_minimax.search(2, next_board, self.opp_color)
+                self.shaping_cache[key] = -opp_value
+            return self.shaping_cache[key]
+        # 'deferred' is added in update(), None has no shaping
+        return 0
 
-        reward = -opp_value
-        return reward
+    def shaping_rewards(self, next_states, done):
+        """ Deferred shaping of a batch: minus the opponent's static evaluation of
+            every next state, 0 for terminal transitions
+        """
+        boards = keys_to_array(next_states, self.width, self.height)
+        opp_values, _, _ = batch_value(boards, self.opp_color, self.streak)
+        return np.where(done, 0, -opp_values)
     
-    def calc_done(self, board, action):
+    def calc_done(self, board, action, next_board=None):
         """
         Return:
             done, isWinner (bool, {bool, None}): whether this game is finished,
                                                  whether the Q player wins, loses, and ties.
         """
-        next_board = calc_next_board(board, action, self.color)
-        if check_streak(next_board, self.color, self.streak) > 0:
+        if next_board is None:
+            next_board = calc_next_board(board, action, self.color)
+        bb = BitBoard.from_board(next_board, self.streak)
+        if bb.is_win(self.color):
             return True, "win"
-        elif check_streak(next_board, self.opp_color, self.streak) > 0:
+        elif bb.is_win(self.opp_color):
             return True, "lose"
-        elif not np.any(np.array(board[-1]) == ' '):
+        elif len(bb.legal_moves()) == 0:
             return True, "tie"
 
         return False, "ongoing"
@@ -151,55 +239,57 @@ class QPlayer(Player):
         return self.transition_counter >= self.batch_size
         
     def update(self):
-        batch = self.buffer.sample_batch(self.batch_size)
-        for sample in batch:
-            state = sample.state
-            action = sample.action
-            next_state = sample.next_state
-            reward = sample.reward 
-            done = sample.done
-            board = self._get_board_from_key(state)
-            next_board = self._get_board_from_key(next_state)
-
-            if state not in self.Q.keys():
-                self.Q[state] = {}
-                for a in available_moves(board):
-                    self.Q[state][a] = 0
-
-            if state not in self.count.keys():
-                self.count[state] = 0            
-
-            if next_state not in self.Q.keys():
-                self.Q[next_state] = {}
-                for a in available_moves(next_board):
-                    self.Q[next_state][a] = 0
-
-            self.count[state] += 1
-            max_next_q = -1e20
-            for action in self.Q[next_state].keys():
-                if self.Q[state][action] > max_next_q:
-                    max_next_q = self.Q[state][action] 
-            try:
-                delta = reward + self.discount_factor*max_next_q - self.Q[state][action]
-            except KeyError:
-                print(f'{available_moves(board) = }')
-                print(f'{available_moves(next_board) = }')
-                print(f'{best_next_action= }, {action =}')
-                exit()
-            self.Q[state][action] += delta/self.count[state]
-#            print(f'{self.Q[state][action] =}')
+        start = time.perf_counter() if metrics.enabled else 0
+        if self.buffer.prioritize:
+            batch, index, weights = self.buffer.sample_batch(self.batch_size)
+        else:
+            batch = self.buffer.sample_batch(self.batch_size)
+            weights = np.ones(len(batch.state))
+        rewards = batch.reward
+        if self.reward_shaping == 'deferred':
+            rewards = rewards + self.shaping_rewards(batch.next_state, batch.done)
+        # gather: inserting may grow the table and move slots, so look both up afterwards
+        slots = self.Q.insert_batch(np.concatenate([batch.state, batch.next_state]))
+        slots, next_slots = slots[:len(batch.state)], slots[len(batch.state):]
+        actions = batch.action.astype(np.int64)
+
+        # TD targets, all taken from the Q values before this batch
+        next_q = self.Q.values[next_slots]
+        no_next = batch.done | np.isneginf(next_q).all(axis=1)
+        max_next_q = np.where(no_next, 0, np.max(np.where(no_next[:, None], 0, next_q), axis=1))
+        delta = rewards + self.discount_factor*max_next_q - self.Q.values[slots, actions]
+        td_errors = np.abs(delta)
+
+        # scatter: a state sampled n times gets n visits and the sum of its n steps,
+        # each divided by the visit count after the batch, whatever their order
+        np.add.at(self.Q.counts, slots, 1)
+        np.add.at(self.Q.values, (slots, actions), weights*delta/self.Q.counts[slots])
+        self.Q.dirty[slots] = True
+        self.Q.changed[slots] = True
+
+        if self.buffer.prioritize:
+            self.buffer.update_priorities(index, td_errors)
 
         if self.epsilon >= self.epsilon_min:
             self.epsilon *= self.epsilon_decay
             self.transition_counter = 0
 
+        if metrics.enabled:
+            metrics.observe('update_seconds', time.perf_counter() - start)
+            metrics.inc('update_transitions_total', len(batch.state))
+            metrics.set_gauge('buffer_fill', len(self.buffer) / self.buffer.capacity)
+
     def _get_key_from_board(self, board):
-        return np.array(board).tobytes()
+        """ Return (key, flipped). If flipped, the key is that of the mirrored board
+            and actions must be mirrored (width-1 - action) to match it.
+        """
+        bb = BitBoard.from_board(board, self.streak)
+        if self.symmetric:
+            return bb.canonical_key()
+        return bb.key(), False
 
     def _get_board_from_key(self, key):
-        np_array = np.frombuffer(key, dtype='<U1')
-        np_array = np_array.reshape((self.height, self.width))
-        return np_array.tolist()
+        return BitBoard.from_key(key, self.width, self.height, self.streak).to_board()
     
     def _move(self, board):
         # report : number of actions varies with the state
@@ -207,33 +297,84 @@ class QPlayer(Player):
         # If some columns are full, we cannot put at full column
         actions = available_moves(board)
 
-        state = self._get_key_from_board(board)
-        # if there's no updated Q values, register key "board" in Q
-        if state not in self.Q.keys() or np.random.random() < self.epsilon:
+        if self.book is not None:
+            book_move = self.book.lookup(board)
+            if book_move is not None:
+                return book_move
+
+        state, flipped = self._get_key_from_board(board)
+        slot = self.Q.find(state)
+        # if there's no updated Q values, pick a random action
+        if slot < 0 or np.random.random() < self.epsilon:
             chosen_action_index = np.random.choice(actions)
         else:
-            Q_max = -1e20
-            for action in self.Q[state].keys():
-                if self.Q[state][action] > Q_max:
-                    Q_max = self.Q[state][action] 
-                    best_index = action
-            tie = [k for k in self.Q[state].keys() if self.Q[state][k] == self.Q[state][best_index]]
+            q = self.Q.values[slot]
+            tie = np.flatnonzero(q == q.max())
             chosen_action_index = np.random.choice(tie)
+            if flipped:
+                chosen_action_index = self.width-1 - chosen_action_index
 
         return chosen_action_index
 
+    def act_batch(self, boards, legal):
+        """ _move for N boards at once, e.g. the (N, H, W) boards and (N, W) legal mask
+            of a vecenv.VecGame. Unseen states and epsilon draws get a random legal
+            column, the others a random one of their best Q values. The book is not used.
+        """
+        keys = array_to_keys(boards)
+        flipped = np.zeros(len(keys), dtype=bool)
+        if self.symmetric:
+            mirror_keys = array_to_keys(boards[:, :, ::-1])
+            flipped = mirror_keys < keys
+            keys = np.where(flipped, mirror_keys, keys)
+        slots = self.Q.find_batch(keys)
+
+        noise = np.random.random(legal.shape)
+        # random legal column, for unseen states and exploration
+        actions = np.argmax(np.where(legal, noise, -1), axis=1)
+        greedy = (slots >= 0) & (np.random.random(len(keys)) >= self.epsilon)
+        if greedy.any():
+            q = np.asarray(self.Q.values[slots[greedy]])
+            q = np.where(flipped[greedy, None], q[:, ::-1], q)
+            best = q == q.max(axis=1, keepdims=True)
+            actions[greedy] = np.argmax(np.where(best, noise[greedy], -1), axis=1)
+        return actions
+
 class MiniMaxPlayer(Player):
     """ MiniMaxPlayer object that extends Player
         The MiniMax algorithm is minimax, the difficulty parameter is the depth to which 
         the search tree is expanded.
+        If time_limit (milliseconds) is given, the player instead deepens the search
+        until the time is up, and difficulty is ignored.
+        incremental_eval scores leaves with the window evaluator (see evaluate.py).
+        book is an OpeningBook (see book.py) looked up before searching.
+        With at most endgame_threshold empty cells the position is solved exactly.
+        seed fixes the choice between equally good moves, for reproducible games.
+        workers > 0 splits fixed-depth searches over that many processes.
     """
     
     difficulty = None
-    def __init__(self, name, color, difficulty=5):
+    def __init__(self, name, color, difficulty=5, time_limit=None, incremental_eval=False,
+                 book=None, endgame_threshold=0, seed=None, workers=0):
         self.type = "MiniMax"
         self.name = name
         self.color = color
         self.difficulty = difficulty
+        self.time_limit = time_limit
+        self.book = book
+        # kept between moves so the transposition table is reused during a game
+        # the window evaluator is mirror-symmetric, so mirrored positions can share entries
+        self.minimax = Minimax(self.color, incremental_eval=incremental_eval,
+                               symmetric_tt=incremental_eval, endgame_threshold=endgame_threshold,
+                               seed=seed)
+        self.parallel = None
+        if workers > 0:
+            self.parallel = ParallelSearch(self.color, workers, seed, incremental_eval=incremental_eval,
+                                           symmetric_tt=incremental_eval,
+                                           endgame_threshold=endgame_threshold)
+        # transposition table counters at the last metrics.enabled search
+        self.tt_probes = 0
+        self.tt_hits = 0
         
     def move(self, board):
         #print("{0}'s turn.  {0} is {1}".format(self.name, self.color))
@@ -242,10 +383,68 @@ class MiniMaxPlayer(Player):
         #time.sleep(random.randrange(8, 17, 1)/10.0)
         #return random.randint(0, 6)
         
-        m = Minimax(self.color)
-        opt_move, _ = m.best_move(self.difficulty, board, self.color)
+        if self.book is not None:
+            book_move = self.book.lookup(board)
+            if book_move is not None:
+                if metrics.enabled:
+                    metrics.inc('book_hits_total')
+                return book_move
+
+        start = time.perf_counter() if metrics.enabled else 0
+        if self.time_limit is not None:
+            opt_move, _ = self.minimax.iterative_search(self.time_limit, board, self.color)
+        elif self.parallel is not None:
+            opt_move, _ = self.parallel.search(self.difficulty, board, self.color)
+        else:
+            opt_move, _ = self.minimax.search(self.difficulty, board, self.color)
+        if metrics.enabled:
+            self._record_search(time.perf_counter() - start)
         return opt_move
 
+    def close(self):
+        """ Shut down the worker processes of a parallel search
+        """
+        if self.parallel is not None:
+            self.parallel.close()
+            self.parallel = None
+
+    def _record_search(self, seconds):
+        metrics.observe('search_seconds', seconds)
+        searcher = self.parallel if self.parallel is not None else self.minimax
+        metrics.inc('search_nodes_total', searcher.nodes)
+        # the counters of the table are cumulative, record what this search added;
+        # parallel searches probe the tables of the workers, which are not counted
+        tt = self.minimax.tt
+        if tt is not None:
+            metrics.inc('tt_probes_total', tt.probes - self.tt_probes)
+            metrics.inc('tt_hits_total', tt.hits - self.tt_hits)
+            self.tt_probes, self.tt_hits = tt.probes, tt.hits
+
+def check_shaping_cache(num_games=100, seed=0):
+    """ Number of non-terminal moves, from random games and their mirror images,
+        where 'cached' shaping rewards differ from 'minimax' ones (should be 0)
+    """
+    rng = random.Random(seed)
+    cached = QPlayer('cached', 'x', reward_shaping='cached')
+    plain = QPlayer('minimax', 'x', reward_shaping='minimax')
+    mismatches = 0
+    for _ in range(num_games):
+        bb = BitBoard()
+        color = 'x'
+        while not bb.is_win('x') and not bb.is_win('o') and bb.legal_moves():
+            if color == 'x':
+                board = bb.to_board()
+                mirror = [row[::-1] for row in board]
+                for b in (board, mirror):
+                    for action in BitBoard.from_board(b).legal_moves():
+                        if cached.calc_done(b, action)[0]:
+                            continue
+                        if cached.calc_reward(b, action) != plain.calc_reward(b, action):
+                            mismatches += 1
+            bb.play(rng.choice(bb.legal_moves()), color)
+            color = 'o' if color == 'x' else 'x'
+    return mismatches
+
 def main():
     player = QPlayer('','o', epsilon=1)
     board = []
@@ -263,5 +462,8 @@ def main():
         
 
 if __name__ == "__main__":
-    main()
+    if '--check-shaping' in sys.argv:
+        print(f'cached and minimax shaping differ on {check_shaping_cache()} moves')
+    else:
+        main()
     
@@ -0,0 +1,202 @@
+import os
+import numpy as np
+import cfg
+
+WIDTH = cfg.WIDTH
+HEIGHT = cfg.HEIGHT
+
+# Fibonacci hashing constant, spreads consecutive BitBoard codes over the table
+_HASH_MULT = 0x9E3779B97F4A7C15
+_MASK64 = (1 << 64) - 1
+
+class QTable(object):
+    """ Open-addressed hash table from integer position codes to per-column Q values.
+
+        keys[slot] holds a BitBoard.key() code (0 marks an empty slot, real codes are
+        never 0), values[slot] the Q value of every column with -inf for full columns,
+        and counts[slot] how many times the state was updated. Collisions are resolved
+        by linear probing, and the table doubles when it gets half full.
+
+        dirty[slot] marks rows changed since the last checkpoint, and changed[slot] rows
+        changed since the last take_changed() (e.g. a broadcast to self-play workers,
+        which apply them with set_rows()). If 'backing' is given
+        (a checkpoint.CheckpointReader), rows missing from memory are read from it the
+        first time find() or insert() asks for them.
+    """
+
+    def __init__(self, width=WIDTH, height=HEIGHT, capacity=1024, backing=None):
+        self.width = width
+        self.height = height
+        self.bits = max(1, int(capacity - 1).bit_length())
+        self.capacity = 1 << self.bits
+        self.keys = np.zeros(self.capacity, dtype=np.int64)
+        self.values = np.zeros((self.capacity, width), dtype=np.float64)
+        self.counts = np.zeros(self.capacity, dtype=np.int64)
+        self.dirty = np.zeros(self.capacity, dtype=bool)
+        self.changed = np.zeros(self.capacity, dtype=bool)
+        self.size = 0
+        self.backing = backing
+
+    def _hash(self, key):
+        return ((key * _HASH_MULT) & _MASK64) >> (64 - self.bits)
+
+    def find(self, key):
+        """ Slot of 'key', or -1 if it is not in the table
+        """
+        slot = self._probe(key)
+        if slot < 0 and self.backing is not None and key in self.backing:
+            return self.insert(key)
+        return slot
+
+    def _probe(self, key):
+        keys = self.keys
+        i = self._hash(key)
+        while True:
+            k = keys[i]
+            if k == key:
+                return i
+            if k == 0:
+                return -1
+            i = (i + 1) & (self.capacity - 1)
+
+    def find_batch(self, keys):
+        """ Vectorized find: array of slots, -1 for keys not in the table.
+            Unlike find(), it does not read missing rows from the backing checkpoint.
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        slots = ((keys.astype(np.uint64) * np.uint64(_HASH_MULT)) >> np.uint64(64 - self.bits)).astype(np.int64)
+        result = np.full(len(keys), -1, dtype=np.int64)
+        pending = np.arange(len(keys))
+        # probe all keys in lockstep, dropping the ones that hit their key or an empty slot
+        while len(pending):
+            k = self.keys[slots[pending]]
+            found = k == keys[pending]
+            result[pending[found]] = slots[pending[found]]
+            pending = pending[~found & (k != 0)]
+            slots[pending] = (slots[pending] + 1) & (self.capacity - 1)
+        return result
+
+    def insert_batch(self, keys):
+        """ Add every missing key of 'keys', return their slots after any growth
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        missing = np.unique(keys[self.find_batch(keys) < 0])
+        # insert() reads rows from the backing checkpoint one key at a time
+        for key in missing:
+            self.insert(int(key))
+        return self.find_batch(keys)
+
+    def legal(self, key):
+        """ Bool array of the columns that are not full in position 'key'
+        """
+        # the marker bit of a full column sits in the extra top row
+        return np.array([not (key >> (col*(self.height+1) + self.height)) & 1
+                         for col in range(self.width)])
+
+    def insert(self, key):
+        """ Slot of 'key', adding it with Q = 0 for every legal column if it is missing
+            (or with its checkpointed row, if there is a backing checkpoint).
+            Adding a key may grow the table, which moves every other slot.
+        """
+        slot = self._probe(key)
+        if slot >= 0:
+            return slot
+        if 2*(self.size + 1) > self.capacity:
+            self._grow()
+        i = self._hash(key)
+        while self.keys[i] != 0:
+            i = (i + 1) & (self.capacity - 1)
+        self.keys[i] = key
+        # a row read from the backing checkpoint is still new to the workers
+        self.changed[i] = True
+        row = self.backing.get(key) if self.backing is not None else None
+        if row is not None:
+            self.values[i], self.counts[i] = row
+            self.dirty[i] = False
+        else:
+            self.values[i] = np.where(self.legal(key), 0.0, -np.inf)
+            self.counts[i] = 0
+            self.dirty[i] = True
+        self.size += 1
+        return i
+
+    def _grow(self):
+        keys, values, counts, dirty, changed = self.keys, self.values, self.counts, self.dirty, self.changed
+        self.bits += 1
+        self.capacity = 1 << self.bits
+        self.keys = np.zeros(self.capacity, dtype=np.int64)
+        self.values = np.zeros((self.capacity, self.width), dtype=np.float64)
+        self.counts = np.zeros(self.capacity, dtype=np.int64)
+        self.dirty = np.zeros(self.capacity, dtype=bool)
+        self.changed = np.zeros(self.capacity, dtype=bool)
+        for old in np.flatnonzero(keys):
+            key = int(keys[old])
+            i = self._hash(key)
+            while self.keys[i] != 0:
+                i = (i + 1) & (self.capacity - 1)
+            self.keys[i] = key
+            self.values[i] = values[old]
+            self.counts[i] = counts[old]
+            self.dirty[i] = dirty[old]
+            self.changed[i] = changed[old]
+
+    def take_changed(self):
+        """ (keys, values, counts) of the rows changed since the last call
+        """
+        slots = np.flatnonzero(self.changed & (self.keys != 0))
+        self.changed[:] = False
+        return self.keys[slots], self.values[slots], self.counts[slots]
+
+    def set_rows(self, keys, values, counts):
+        """ Overwrite the rows of 'keys', adding missing ones, e.g. with take_changed()
+            of another table
+        """
+        slots = self.insert_batch(keys)
+        self.values[slots] = values
+        self.counts[slots] = counts
+
+    def __contains__(self, key):
+        return self.find(key) >= 0
+
+    def __len__(self):
+        return self.size
+
+    def nbytes(self):
+        return (self.keys.nbytes + self.values.nbytes + self.counts.nbytes + self.dirty.nbytes
+                + self.changed.nbytes)
+
+class FrozenQTable(object):
+    """ Read-only Q table over an index written by checkpoint.export.
+
+        keys and values are memory-mapped, so opening is instant and processes serving
+        the same index share one copy through the page cache. Slots are positions in the
+        sorted keys, found by binary search. Only find(), find_batch() and values are
+        supported.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.keys = np.load(os.path.join(path, 'keys.npy'), mmap_mode='r')
+        self.values = np.load(os.path.join(path, 'values.npy'), mmap_mode='r')
+
+    def find(self, key):
+        i = int(np.searchsorted(self.keys, key))
+        if i < len(self.keys) and self.keys[i] == key:
+            return i
+        return -1
+
+    def find_batch(self, keys):
+        """ Vectorized find: array of slots, -1 for keys not in the table
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        slots = np.searchsorted(self.keys, keys)
+        found = np.zeros(len(keys), dtype=bool)
+        inside = slots < len(self.keys)
+        found[inside] = self.keys[slots[inside]] == keys[inside]
+        return np.where(found, slots, -1)
+
+    def __contains__(self, key):
+        return self.find(key) >= 0
+
+    def __len__(self):
+        return len(self.keys)
@@ -0,0 +1,142 @@
+import os
+import argparse
+
+# A record file starts with MAGIC and the width, height and streak of its games, one
+# byte each. Every game follows as
+#     1 byte : number of moves n
+#     1 byte : result, X_WIN, O_WIN or DRAW
+#     (n+1)//2 bytes : the columns played, two 4-bit columns per byte, first move in
+#                      the low nibble, 'x' moving first
+# so a 30-move game takes 17 bytes.
+MAGIC = b'C4G1'
+X_WIN, O_WIN, DRAW = 0, 1, 2
+RESULTS = {X_WIN: "'x' wins", O_WIN: "'o' wins", DRAW: 'draw'}
+
+def pack_game(moves, result):
+    """ Bytes of one game
+    """
+    data = bytearray((len(moves), result))
+    for i in range(0, len(moves), 2):
+        high = moves[i+1] if i+1 < len(moves) else 0
+        data.append(moves[i] | high << 4)
+    return bytes(data)
+
+def unpack_moves(data, n):
+    moves = []
+    for byte in data:
+        moves.append(byte & 0xF)
+        moves.append(byte >> 4)
+    return moves[:n]
+
+class GameRecorder(object):
+    """ Appends finished games to a binary record file at 'path'.
+        Games are buffered and written every 'flush_every' games and on close().
+    """
+
+    def __init__(self, path, width, height, streak, flush_every=100):
+        if width > 16 or width*height > 255:
+            raise ValueError('records hold up to 16 columns and 255 moves')
+        self.path = path
+        self.header = MAGIC + bytes((width, height, streak))
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            self.file = open(path, 'r+b')
+            data = self.file.read()
+            if data[:len(self.header)] != self.header:
+                self.file.close()
+                raise ValueError(f'{path} holds games of another board size')
+            # drop a game cut short by a crash, games appended after it could not be read
+            self.file.seek(complete_length(data))
+            self.file.truncate()
+        else:
+            self.file = open(path, 'wb')
+            self.file.write(self.header)
+        self.flush_every = flush_every
+        self.pending = []
+
+    def write(self, moves, result):
+        self.pending.append(pack_game(moves, result))
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        self.file.write(b''.join(self.pending))
+        self.pending = []
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def read_header(path):
+    """ (width, height, streak) of the games in a record file
+    """
+    with open(path, 'rb') as f:
+        header = f.read(len(MAGIC) + 3)
+    if header[:len(MAGIC)] != MAGIC:
+        raise ValueError(f'{path} is not a game record file')
+    return tuple(header[len(MAGIC):])
+
+def game_offsets(data):
+    """ Yield the offset of every complete game in the bytes of a record file
+    """
+    i = len(MAGIC) + 3
+    while i + 2 <= len(data):
+        size = (data[i] + 1)//2
+        if i + 2 + size > len(data):
+            # the last game was cut short, e.g. by a crash while writing
+            break
+        yield i
+        i += 2 + size
+
+def complete_length(data):
+    """ Length of the bytes of a record file up to the end of its last complete game
+    """
+    end = len(MAGIC) + 3
+    for i in game_offsets(data):
+        end = i + 2 + (data[i] + 1)//2
+    return end
+
+def read_games(path):
+    """ Yield (moves, result) for every game of a record file
+    """
+    read_header(path)
+    with open(path, 'rb') as f:
+        data = f.read()
+    for i in game_offsets(data):
+        n, result = data[i], data[i+1]
+        yield unpack_moves(data[i+2:i+2+(n + 1)//2], n), result
+
+def main():
+    parser = argparse.ArgumentParser(description='Show games from a binary record file')
+    parser.add_argument('path')
+    parser.add_argument('--game', type=int, help='replay this game (0-based) move by move')
+    args = parser.parse_args()
+    width, height, streak = read_header(args.path)
+    if args.game is None:
+        counts = {result: 0 for result in RESULTS}
+        for _, result in read_games(args.path):
+            counts[result] += 1
+        print(f'{sum(counts.values())} games on a {width}x{height} board, streak {streak}')
+        for result, count in counts.items():
+            print(f'{RESULTS[result]}: {count}')
+        return
+
+    from connect4 import Game
+    num_games = 0
+    for moves, result in read_games(args.path):
+        if num_games == args.game:
+            g = Game(width, height, streak, verbose=True)
+            g.replay(moves, show=True)
+            print(RESULTS[result])
+            return
+        num_games += 1
+    print(f'{args.path} has only {num_games} games')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,376 @@
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import time
+import cfg
+import metrics
+from concurrent.futures import ProcessPoolExecutor
+from bitboard import BitBoard
+from minimax import Minimax
+from evaluate import keys_to_array, EMPTY
+
+WIDTH = cfg.WIDTH
+HEIGHT = cfg.HEIGHT
+STREAK = cfg.STREAK
+
+DEFAULT_DEADLINE_MS = 1000
+# workers stop searching this long before a deadline, so the reply can still make it
+SEARCH_MARGIN_MS = 20
+AIS = ('minimax', 'q')
+
+logger = logging.getLogger('server')
+
+# players of a worker process, kept between requests so transposition tables are reused
+_worker_minimax = {}
+_worker_qplayer = None
+
+def _init_worker(q_path, seed):
+    global _worker_qplayer
+    for color in ('x', 'o'):
+        _worker_minimax[color] = Minimax(color, seed=seed)
+    if q_path is not None:
+        from player import QPlayer
+        # training plays the QPlayer as 'x', so its table only holds positions with 'x' to move
+        _worker_qplayer = QPlayer('server', 'x', epsilon=0)
+        _worker_qplayer.load_readonly(q_path)
+
+def _worker_moves(batch):
+    """ Moves for a batch of (ai, difficulty, key, color, deadline) requests, with
+        None for requests whose deadline (time.time() seconds) passed in the queue.
+        Q requests are answered together with QPlayer.act_batch, minimax requests
+        one after the other, each searched deeper until difficulty or its share of the
+        time left, so the first searches of a batch cannot starve the last ones.
+    """
+    moves = [None]*len(batch)
+    q_index = [i for i, request in enumerate(batch) if request[0] == 'q']
+    if q_index:
+        boards = keys_to_array([batch[i][2] for i in q_index], WIDTH, HEIGHT)
+        legal = (boards != EMPTY).sum(axis=1) < HEIGHT
+        for i, move in zip(q_index, _worker_qplayer.act_batch(boards, legal)):
+            moves[i] = int(move)
+    searches_left = len(batch) - len(q_index)
+    for i, (ai, difficulty, key, color, deadline) in enumerate(batch):
+        if ai != 'minimax':
+            continue
+        time_left = ((deadline - time.time())*1000 - SEARCH_MARGIN_MS) / searches_left
+        searches_left -= 1
+        if time_left <= 0:
+            continue
+        board = BitBoard.from_key(key, WIDTH, HEIGHT, STREAK).to_board()
+        move, _ = _worker_minimax[color].iterative_search(time_left, board, color, max_depth=difficulty)
+        moves[i] = int(move)
+    return moves
+
+def quick_move(bb, color):
+    """ Move for a request that missed its deadline: win if possible, else block
+        the opponent's win, else the legal column closest to the center
+    """
+    opp_color = 'x' if color == 'o' else 'o'
+    legal_moves = bb.legal_moves()
+    for c in (color, opp_color):
+        for col in legal_moves:
+            if bb.is_winning_move(col, c):
+                return col
+    center = (bb.width-1)/2
+    return min(legal_moves, key=lambda col: abs(col - center))
+
+class Session(object):
+    """ One game between a client, playing 'human', and the AI
+    """
+
+    def __init__(self, game_id, ai, difficulty, human):
+        self.game_id = game_id
+        self.ai = ai
+        self.difficulty = difficulty
+        self.human = human
+        self.ai_color = 'x' if human == 'o' else 'o'
+        self.bb = BitBoard(WIDTH, HEIGHT, STREAK)
+        self.moves = []
+        self.finished = False
+        self.winner = None
+        # one move at a time, even if a client sends several
+        self.lock = asyncio.Lock()
+
+    def play(self, col):
+        color = self.bb.color_to_move()
+        self.bb.play(col, color)
+        self.moves.append(col)
+        if self.bb.is_win(color):
+            self.finished = True
+            self.winner = color
+        elif len(self.bb.legal_moves()) == 0:
+            self.finished = True
+
+    def state(self):
+        return {
+            'ok': True,
+            'game': self.game_id,
+            # rows from the bottom up, as in Game.board
+            'board': [''.join(row) for row in self.bb.to_board()],
+            'moves': self.moves,
+            'to_move': self.bb.color_to_move(),
+            'finished': self.finished,
+            'winner': self.winner,
+        }
+
+class GameServer(object):
+    """ Hosts games against the AI over newline-delimited JSON on TCP.
+
+        Requests are JSON objects with an 'op' and an optional 'id' echoed in the reply:
+            {"op": "new", "ai": "minimax" or "q", "difficulty": 4, "human": "x" or "o"}
+                ("q" plays 'x', like the QPlayer in training, so it needs "human": "o")
+            {"op": "move", "game": 1, "column": 2, "deadline_ms": 500}
+            {"op": "state", "game": 1}
+            {"op": "close", "game": 1}
+        Replies carry the game state, and after an AI move 'ai_move' and 'fallback'.
+
+        AI moves are searched in a process pool, so the event loop only does bookkeeping.
+        Pending move requests are batched: while every worker is busy they queue up, and
+        a worker that frees up takes all of them (up to max_batch) in one call. Every
+        request has a deadline; a search stops in time for it, and a request still
+        unanswered at its deadline, or whose worker failed, gets quick_move instead,
+        so a slow search delays no other game and latency is bounded by the deadline.
+    """
+
+    def __init__(self, workers=None, max_batch=16, batch_window_ms=0,
+                 deadline_ms=DEFAULT_DEADLINE_MS, q_path=None, max_sessions=10000, seed=None):
+        self.workers = workers or os.cpu_count()
+        self.max_batch = max_batch
+        self.batch_window = batch_window_ms/1000
+        self.deadline_ms = deadline_ms
+        self.q_path = q_path
+        self.max_sessions = max_sessions
+        self.pool = ProcessPoolExecutor(self.workers, initializer=_init_worker,
+                                        initargs=(q_path, seed))
+        self.sessions = {}
+        self.game_ids = itertools.count(1)
+        self.pending = None
+        self.server = None
+        self.dispatcher = None
+
+    async def start(self, host='127.0.0.1', port=4444):
+        # fork the workers before any socket is open, or they would inherit the client
+        # connections and keep them open after the server closes them
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.pool, os.getpid)
+                               for _ in range(self.workers)])
+        self.pending = asyncio.Queue()
+        self.dispatcher = asyncio.create_task(self.dispatch())
+        self.server = await asyncio.start_server(self.handle_client, host, port)
+        return self.server
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        if self.dispatcher is not None:
+            self.dispatcher.cancel()
+        self.pool.shutdown(cancel_futures=True)
+
+    async def dispatch(self):
+        """ Send batches of pending move requests to the pool, one batch per free worker
+        """
+        loop = asyncio.get_running_loop()
+        free_workers = asyncio.Semaphore(self.workers)
+        while True:
+            batch = [await self.pending.get()]
+            # requests arriving while we wait for a worker join this batch
+            await free_workers.acquire()
+            if self.batch_window > 0:
+                await asyncio.sleep(self.batch_window)
+            while len(batch) < self.max_batch and not self.pending.empty():
+                batch.append(self.pending.get_nowait())
+            # skip requests whose caller gave up at the deadline
+            batch = [(request, future) for request, future in batch if not future.done()]
+            if not batch:
+                free_workers.release()
+                continue
+            if metrics.enabled:
+                metrics.observe('server_batch_size', len(batch), buckets=(1, 2, 4, 8, 16, 32, 64))
+            result = loop.run_in_executor(self.pool, _worker_moves, [request for request, _ in batch])
+            result.add_done_callback(lambda result, batch=batch: self._deliver(result, batch, free_workers))
+
+    def _deliver(self, result, batch, free_workers):
+        free_workers.release()
+        if result.exception() is not None:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(result.exception())
+            return
+        for (_, future), move in zip(batch, result.result()):
+            if not future.done():
+                future.set_result(move)
+
+    async def ai_move(self, session, deadline_ms):
+        """ Play the AI's move in 'session', return (move, whether quick_move was used)
+        """
+        start = time.perf_counter() if metrics.enabled else 0
+        deadline = time.time() + deadline_ms/1000
+        future = asyncio.get_running_loop().create_future()
+        request = (session.ai, session.difficulty, session.bb.key(), session.ai_color, deadline)
+        self.pending.put_nowait((request, future))
+        try:
+            move = await asyncio.wait_for(future, deadline_ms/1000)
+        except asyncio.TimeoutError:
+            move = None
+        except Exception:
+            # e.g. a worker died; the game must still go on
+            logger.exception('AI move of game %d failed', session.game_id)
+            if metrics.enabled:
+                metrics.inc('server_errors_total')
+            move = None
+        fallback = move is None
+        if fallback:
+            move = quick_move(session.bb, session.ai_color)
+        session.play(move)
+        if metrics.enabled:
+            metrics.observe('server_move_seconds', time.perf_counter() - start)
+            metrics.inc('server_moves_total')
+            if fallback:
+                metrics.inc('server_fallbacks_total')
+        return move, fallback
+
+    async def handle_client(self, reader, writer):
+        games = set() # games of this connection, closed when it disconnects
+        tasks = set()
+        write_lock = asyncio.Lock()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                # answer requests concurrently, so games on one connection do not wait
+                # for each other
+                task = asyncio.create_task(self.respond(line, games, writer, write_lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except ConnectionError:
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            for game_id in games:
+                self.sessions.pop(game_id, None)
+            writer.close()
+
+    async def respond(self, line, games, writer, write_lock):
+        message = None
+        try:
+            message = json.loads(line)
+            if not isinstance(message, dict):
+                raise ValueError('a request must be a JSON object')
+            reply = await self.handle(message, games)
+        except (ValueError, TypeError) as e:
+            reply = {'ok': False, 'error': str(e)}
+        except Exception as e:
+            # e.g. a worker died; the client still gets an answer
+            reply = {'ok': False, 'error': f'internal error: {e!r}'}
+        if isinstance(message, dict) and 'id' in message:
+            reply['id'] = message['id']
+        async with write_lock:
+            writer.write(json.dumps(reply).encode() + b'\n')
+            await writer.drain()
+
+    def session(self, message):
+        session = self.sessions.get(message.get('game'))
+        if session is None:
+            raise ValueError('unknown game')
+        return session
+
+    async def handle(self, message, games):
+        op = message.get('op')
+        if op == 'new':
+            ai = message.get('ai', 'minimax')
+            if ai not in AIS:
+                raise ValueError(f'ai must be one of {AIS}')
+            if ai == 'q' and self.q_path is None:
+                raise ValueError('the server has no Q table')
+            human = message.get('human', 'x')
+            if human not in ('x', 'o'):
+                raise ValueError("human must be 'x' or 'o'")
+            if ai == 'q' and human != 'o':
+                raise ValueError("the Q table only plays 'x', so human must be 'o'")
+            if len(self.sessions) >= self.max_sessions:
+                raise ValueError('too many games')
+            difficulty = max(1, int(message.get('difficulty', 4)))
+            session = Session(next(self.game_ids), ai, difficulty, human)
+            self.sessions[session.game_id] = session
+            games.add(session.game_id)
+            reply = {}
+            if human == 'o':
+                # 'x' moves first
+                async with session.lock:
+                    reply['ai_move'], reply['fallback'] = await self.ai_move(session, self.deadline(message))
+            return {**session.state(), **reply}
+
+        elif op == 'move':
+            session = self.session(message)
+            async with session.lock:
+                if session.finished:
+                    raise ValueError('the game is over')
+                if session.bb.color_to_move() != session.human:
+                    raise ValueError('not your turn')
+                col = message.get('column')
+                if not isinstance(col, int) or not 0 <= col < WIDTH or not session.bb.can_play(col):
+                    raise ValueError('illegal column')
+                session.play(col)
+                reply = {}
+                if not session.finished:
+                    reply['ai_move'], reply['fallback'] = await self.ai_move(session, self.deadline(message))
+                return {**session.state(), **reply}
+
+        elif op == 'state':
+            return self.session(message).state()
+
+        elif op == 'close':
+            session = self.session(message)
+            del self.sessions[session.game_id]
+            games.discard(session.game_id)
+            return {'ok': True, 'game': session.game_id}
+
+        raise ValueError(f'unknown op {op!r}')
+
+    def deadline(self, message):
+        """ Deadline of a move request in milliseconds, at most the server's
+        """
+        return min(float(message.get('deadline_ms', self.deadline_ms)), self.deadline_ms)
+
+async def serve(args):
+    server = GameServer(args.workers, args.max_batch, args.batch_window_ms, args.deadline_ms,
+                        args.q_table, args.max_sessions, args.seed)
+    tcp_server = await server.start(args.host, args.port)
+    print(f'serving games on {args.host}:{args.port}')
+    try:
+        await tcp_server.serve_forever()
+    finally:
+        await server.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve games against the AI, JSON lines over TCP')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=4444)
+    parser.add_argument('--workers', type=int, help='search processes, one per CPU by default')
+    parser.add_argument('--max-batch', type=int, default=16, help='most move requests sent to a worker at once')
+    parser.add_argument('--batch-window-ms', type=float, default=0,
+                        help='wait this long for more requests before sending a batch')
+    parser.add_argument('--deadline-ms', type=float, default=DEFAULT_DEADLINE_MS,
+                        help='longest time an AI move may take, requests may ask for less')
+    parser.add_argument('--q-table', help='Q table exported with checkpoint.export, enables ai "q" (as \'x\')')
+    parser.add_argument('--max-sessions', type=int, default=10000)
+    parser.add_argument('--seed', type=int, help='fixes the choice between equally good moves')
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve metrics in the Prometheus text format on this port')
+    args = parser.parse_args()
+    if args.metrics_port:
+        metrics.enable()
+        metrics.serve(args.metrics_port)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+from transposition import EXACT, LOWER, UPPER
+
+SOLVER_CACHE_SIZE = 1e6
+
+class Solver(object):
+    """ Exact connect n solver: negamax with alpha-beta on a BitBoard.
+
+        Scores are from the point of view of the side to move: 0 for a draw,
+        (empty cells + 1)//2 for a win on this move, one less for every two plies the
+        win takes, and the negative of that for a loss. Solved bounds are cached by the
+        canonical hash, so mirror images share entries, for the lifetime of the object.
+    """
+
+    def __init__(self, cache_size=SOLVER_CACHE_SIZE):
+        self.cache = {}
+        self.cache_size = cache_size
+        self.nodes = 0
+
+    def solve(self, bb, color):
+        """ Exact score of position 'bb' with 'color' to move
+        """
+        self.nodes = 0
+        bb = bb.copy()
+        return self._negamax(bb, color, -float('inf'), float('inf'))
+
+    def best_moves(self, bb, color):
+        """ (moves with the best exact score, score) for 'color' to move in 'bb'
+        """
+        self.nodes = 0
+        bb = bb.copy()
+        cells = bb.width*bb.height
+        opp_color = 'x' if color == 'o' else 'o'
+        best, tie = None, []
+        for col in bb.legal_moves():
+            if bb.is_winning_move(col, color):
+                score = (cells + 1 - bb.num_pieces())//2
+            else:
+                bb.play(col, color)
+                # search only scores that could tie or beat the best so far
+                alpha = -float('inf') if best is None else best - 1
+                score = -self._negamax(bb, opp_color, -float('inf'), -alpha)
+                bb.undo()
+            if best is None or score > best:
+                best, tie = score, [col]
+            elif score == best:
+                tie.append(col)
+        return tie, best
+
+    def _negamax(self, bb, color, alpha, beta):
+        self.nodes += 1
+        legal_moves = bb.legal_moves()
+        if len(legal_moves) == 0:
+            return 0
+        n = bb.num_pieces()
+        cells = bb.width*bb.height
+        for col in legal_moves:
+            if bb.is_winning_move(col, color):
+                return (cells + 1 - n)//2
+
+        # we cannot win on this move, so at best on our next one
+        max_score = (cells - 1 - n)//2
+        if beta > max_score:
+            beta = max_score
+            if alpha >= beta:
+                return beta
+
+        key, _ = bb.canonical_search_hash(color)
+        entry = self.cache.get(key)
+        if entry is not None:
+            flag, value = entry
+            if flag == EXACT:
+                return value
+            elif flag == LOWER:
+                alpha = max(alpha, value)
+            else:
+                beta = min(beta, value)
+            if alpha >= beta:
+                return value
+        alpha_orig = alpha
+
+        opp_color = 'x' if color == 'o' else 'o'
+        center = (bb.width-1)/2
+        best = -float('inf')
+        for col in sorted(legal_moves, key=lambda c: abs(c - center)):
+            bb.play(col, color)
+            score = -self._negamax(bb, opp_color, -beta, -alpha)
+            bb.undo()
+            if score > best:
+                best = score
+                if best > alpha:
+                    alpha = best
+                    if alpha >= beta:
+                        break
+
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        if best <= alpha_orig:
+            self.cache[key] = (UPPER, best)
+        elif best >= beta:
+            self.cache[key] = (LOWER, best)
+        else:
+            self.cache[key] = (EXACT, best)
+        return best
@@ -8,60 +8,212 @@
 # February 27, 2012
 
 from connect4 import *
+from memory import Transition
+import multiprocessing as mp
+import queue
+import random
+import argparse
 import time
 import pickle
+import signal
+import metrics
 
-def main():
+def main(stats_writer=None, record=None, reward_shaping='deferred'):
     """ Play a game!
+        stats_writer (a metrics.StatsWriter) is given a chance to write after every game.
+        record is a file every game is appended to, see records.py.
+        reward_shaping is passed to the QPlayer, see QPlayer.calc_reward.
     """
     
     stats = [0, 0, 0] # [p1 wins, p2 wins, ties]
     avg_reward = 0
     num_update = 0
 
-    g = Game(verbose=False)
+    g = Game(headless=True, record=record, reward_shaping=reward_shaping)
 #    g = Game(verbose=True)
 #    g.print_state()
     player1 = g.players[0] # Q
     player2 = g.players[1]
     
     
-    exit = False
-    while True:
-        while not g.finished:
-#            time.sleep(.6)
-            g.next_move()
+    try:
+        exit = False
+        while True:
+            while not g.finished:
+#                time.sleep(.6)
+                g.next_move()
         
-        g.find_streak()
-#        g.print_state(stats)
+#            g.print_state(stats)
         
-        if g.winner == None:
-            stats[2] += 1
+            if g.winner == None:
+                stats[2] += 1
         
-        elif g.winner == player1:
-            stats[0] += 1
+            elif g.winner == player1:
+                stats[0] += 1
             
-        elif g.winner == player2:
-            stats[1] += 1
+            elif g.winner == player2:
+                stats[1] += 1
         
-        avg_reward += player1.sum_reward
-        player1.reset()
-        g.new_game()
-#        g.print_state(stats)
-        if player1.is_updatable():
-            player1.update()
-            player1.save()
-#            for i in range(5):
-#                print(f'Q table is updated {num_update = }')
-            num_update += 1
-#            time.sleep(.5)
-
-        if (sum(stats)+1) % 100 == 0:
-            save_file(stats, 'data/stats.pkl')
-            save_file(avg_reward/100, 'data/avg_reward.pkl')
-            print_status(player1, player2, stats, avg_reward, num_update)
-            avg_reward = 0 # reset avg reward
-            
+            avg_reward += player1.sum_reward
+            player1.reset()
+            g.new_game()
+            if metrics.enabled:
+                metrics.inc('games_total')
+                if stats_writer is not None:
+                    stats_writer.maybe_write()
+#            g.print_state(stats)
+            if player1.is_updatable():
+                player1.update()
+                player1.save()
+#                for i in range(5):
+#                    print(f'Q table is updated {num_update = }')
+                num_update += 1
+#                time.sleep(.5)
+
+            if (sum(stats)+1) % 100 == 0:
+                save_file(stats, 'data/stats.pkl')
+                save_file(avg_reward/100, 'data/avg_reward.pkl')
+                print_status(player1, player2, stats, avg_reward, num_update)
+                avg_reward = 0 # reset avg reward
+    finally:
+        # flush recorded games
+        g.close()
+
+class QueueBuffer(object):
+    """ Stand-in for ReplayBuffer in self-play workers.
+        Keeps the transitions of the current game until they are sent to the learner.
+    """
+
+    def __init__(self):
+        self.memory = []
+
+    def push(self, *args):
+        self.memory.append(Transition(*args))
+
+    def flush(self):
+        transitions = self.memory
+        self.memory = []
+        return transitions
+
+def self_play_worker(worker_id, transition_queue, snapshot_queue, stop_event, record=None,
+                     reward_shaping='deferred'):
+    """ Play games forever and send (winner, sum of rewards, transitions) after each one.
+        Q rows and epsilon are updated from the learner's broadcasts between games.
+        Games are recorded to '<record>.<worker_id>', one file per worker.
+    """
+    g = Game(headless=True, record=f'{record}.{worker_id}' if record is not None else None,
+             reward_shaping=reward_shaping)
+    player1 = g.players[0] # Q
+    player2 = g.players[1]
+    player1.buffer = QueueBuffer()
+    # every QPlayer seeds numpy the same way, so give each worker its own games
+    np.random.seed(worker_id + 1)
+    random.seed(worker_id + 1)
+
+    try:
+        while not stop_event.is_set():
+            while not g.finished:
+                g.next_move()
+
+            if g.winner == None:
+                winner = 2
+            elif g.winner == player1:
+                winner = 0
+            else:
+                winner = 1
+            game = (winner, player1.sum_reward, player1.buffer.flush())
+            # a full queue must not keep the worker from seeing stop_event
+            while not stop_event.is_set():
+                try:
+                    transition_queue.put(game, timeout=1)
+                    break
+                except queue.Full:
+                    pass
+            player1.reset()
+            g.new_game()
+
+            # every broadcast only holds the rows changed since the one before, apply them in order
+            while True:
+                try:
+                    rows, player1.epsilon = snapshot_queue.get_nowait()
+                except queue.Empty:
+                    break
+                player1.Q.set_rows(*rows)
+    except KeyboardInterrupt:
+        # Ctrl-C reaches the workers too, the learner sets stop_event
+        pass
+    finally:
+        g.close()
+        # exit without waiting for the learner to read what is left in the queue
+        transition_queue.cancel_join_thread()
+
+def parallel_main(num_workers, broadcast_interval=10, stats_writer=None, record=None,
+                  reward_shaping='deferred'):
+    """ Self-play with num_workers worker processes and a learner in this process.
+        The learner owns the replay buffer, runs QPlayer.update, and sends the Q rows
+        changed since the last broadcast to the workers every broadcast_interval updates.
+        Metrics are only collected in the learner, so search and reward hooks,
+        which run in the workers, are not recorded.
+    """
+    stats = [0, 0, 0] # [p1 wins, p2 wins, ties]
+    avg_reward = 0
+    num_update = 0
+
+    g = Game(headless=True, reward_shaping=reward_shaping)
+    learner = g.players[0]
+    player2 = g.players[1]
+
+    transition_queue = mp.Queue(maxsize=10*num_workers)
+    # not bounded: broadcasts are deltas, a worker must get every one of them
+    snapshot_queues = [mp.Queue() for _ in range(num_workers)]
+    stop_event = mp.Event()
+    workers = [mp.Process(target=self_play_worker,
+                          args=(i, transition_queue, snapshot_queues[i], stop_event, record, reward_shaping),
+                          daemon=True)
+               for i in range(num_workers)]
+    for w in workers:
+        w.start()
+
+    try:
+        while True:
+            winner, sum_reward, transitions = transition_queue.get()
+            for transition in transitions:
+                learner.buffer.push(*transition)
+            learner.transition_counter += len(transitions)
+            stats[winner] += 1
+            avg_reward += sum_reward
+            if metrics.enabled:
+                metrics.inc('games_total')
+                if stats_writer is not None:
+                    stats_writer.maybe_write()
+
+            if learner.is_updatable():
+                learner.update()
+                learner.save()
+                num_update += 1
+                if num_update % broadcast_interval == 0:
+                    # only the rows changed since the last broadcast, not the whole table
+                    rows = learner.Q.take_changed()
+                    for q in snapshot_queues:
+                        q.put((rows, learner.epsilon))
+
+            if (sum(stats)+1) % 100 == 0:
+                save_file(stats, 'data/stats.pkl')
+                save_file(avg_reward/100, 'data/avg_reward.pkl')
+                print_status(learner, player2, stats, avg_reward, num_update)
+                avg_reward = 0 # reset avg reward
+    finally:
+        # let the workers finish their game and close their records
+        stop_event.set()
+        for w in workers:
+            w.join(timeout=30)
+            if w.is_alive():
+                w.terminate()
+        # broadcasts the workers never read must not keep this process from exiting
+        for q in snapshot_queues:
+            q.cancel_join_thread()
+        g.close()
+
 def save_file(variable, path):
     with open(path, 'wb') as f:
         pickle.dump(variable, f)
@@ -70,4 +222,33 @@ def print_status(player1, player2, stats, avg_reward, num_update):
     print(f'{player1.name}: {stats[0]}, {player2.name}: {stats[1]}, ties : {stats[2]} , {avg_reward = }, {num_update =}')
         
 if __name__ == "__main__": # Default "main method" idiom.
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=0,
+                        help='number of self-play processes, 0 plays in this process')
+    parser.add_argument('--broadcast-interval', type=int, default=10,
+                        help='send the Q table to the workers every this many updates')
+    parser.add_argument('--stats-file', help='append metrics as JSON lines to this file')
+    parser.add_argument('--stats-interval', type=float, default=60,
+                        help='seconds between two lines of the stats file')
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve metrics in the Prometheus text format on this port')
+    parser.add_argument('--record', help='append every self-play game to this binary record file')
+    parser.add_argument('--reward-shaping', default='deferred',
+                        choices=('minimax', 'cached', 'deferred', 'none'),
+                        help='shaping of non-terminal rewards, deferred keeps searches out of self-play')
+    args = parser.parse_args()
+    # stop on SIGTERM (e.g. from a job scheduler) as on Ctrl-C, so game records get closed;
+    # worker processes inherit the handler
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    reward_shaping = None if args.reward_shaping == 'none' else args.reward_shaping
+    stats_writer = None
+    if args.stats_file or args.metrics_port:
+        metrics.enable()
+        if args.stats_file:
+            stats_writer = metrics.StatsWriter(args.stats_file, args.stats_interval)
+        if args.metrics_port:
+            metrics.serve(args.metrics_port)
+    if args.workers > 0:
+        parallel_main(args.workers, args.broadcast_interval, stats_writer, args.record, reward_shaping)
+    else:
+        main(stats_writer, args.record, reward_shaping)
@@ -0,0 +1,54 @@
+import sys
+
+# bound types of a stored value
+EXACT = 0
+LOWER = 1 # search failed high, true value >= value
+UPPER = 2 # search failed low, true value <= value
+
+# rough size of one entry: list slot + tuple of 6 + boxed hash and value
+ENTRY_BYTES = 8 + sys.getsizeof((0, 0, 0, 0, 0, 0)) + 2*32
+
+class TranspositionTable(object):
+    """ Fixed-size transposition table indexed by Zobrist hash.
+
+        Each slot holds one (hash, depth, flag, value, move, age) tuple.
+        Replacement policy: an entry is overwritten by a new one for the same position,
+        by any entry if it was stored during an older search, and otherwise only by
+        an entry searched at least as deep.
+    """
+
+    def __init__(self, max_bytes):
+        self.size = max(1, int(max_bytes // ENTRY_BYTES))
+        self.table = [None]*self.size
+        self.age = 0
+        self.probes = 0
+        self.hits = 0
+
+    def new_search(self):
+        """ Start a new search generation, so older entries become replaceable
+        """
+        self.age += 1
+
+    def probe(self, key):
+        """ Return (depth, flag, value, move) stored for 'key', or None
+        """
+        self.probes += 1
+        entry = self.table[key % self.size]
+        if entry is not None and entry[0] == key:
+            self.hits += 1
+            return entry[1:5]
+        return None
+
+    def store(self, key, depth, flag, value, move):
+        index = key % self.size
+        entry = self.table[index]
+        if entry is None or entry[0] == key or entry[5] != self.age or depth >= entry[1]:
+            self.table[index] = (key, depth, flag, value, move, self.age)
+
+    def clear(self):
+        self.table = [None]*self.size
+        self.probes = 0
+        self.hits = 0
+
+    def __len__(self):
+        return sum(entry is not None for entry in self.table)
@@ -0,0 +1,121 @@
+import numpy as np
+import cfg
+from evaluate import EMPTY, X
+
+WIDTH = cfg.WIDTH
+HEIGHT = cfg.HEIGHT
+STREAK = cfg.STREAK
+
+# (row, col) steps of the vertical, horizontal, diagonal ↗ and diagonal ↘ lines
+DIRECTIONS = ((1, 0), (0, 1), (1, 1), (-1, 1))
+
+class VecGame(object):
+    """ N connect n games played in lockstep on NumPy arrays.
+
+        boards is an (N, H, W) int8 array with X (1), O (-1) or EMPTY (0), row 0 at the
+        bottom as in Game. 'x' moves first in every game. step() plays one move in every
+        game for the side to move, and games that end are reset right away.
+    """
+
+    def __init__(self, num_games, width=WIDTH, height=HEIGHT, streak=STREAK):
+        self.num_games = num_games
+        self.width = width
+        self.height = height
+        self.streak = streak
+        self.boards = np.zeros((num_games, height, width), dtype=np.int8)
+        self.heights = np.zeros((num_games, width), dtype=np.int64)
+        self.turn = np.full(num_games, X, dtype=np.int8) # piece of the side to move
+        self.index = np.arange(num_games)
+        self.winners = np.zeros(num_games, dtype=np.int8) # winner of the last finished game
+
+    def reset(self, mask=None):
+        """ Start new games, all of them or those where 'mask' is True
+        """
+        if mask is None:
+            mask = np.ones(self.num_games, dtype=bool)
+        self.boards[mask] = EMPTY
+        self.heights[mask] = 0
+        self.turn[mask] = X
+
+    def legal_mask(self):
+        """ (N, W) bool array of the columns that are not full
+        """
+        return self.heights < self.height
+
+    def wins_at(self, rows, cols, pieces):
+        """ Whether a piece 'pieces' at (rows, cols) of every board completes a streak.
+            The cell itself is taken as filled, so this also tests moves not yet played.
+        """
+        won = np.zeros(self.num_games, dtype=bool)
+        for dr, dc in DIRECTIONS:
+            length = np.ones(self.num_games, dtype=np.int64)
+            for sign in (1, -1):
+                alive = np.ones(self.num_games, dtype=bool)
+                for k in range(1, self.streak):
+                    r = rows + sign*dr*k
+                    c = cols + sign*dc*k
+                    inside = (r >= 0) & (r < self.height) & (c >= 0) & (c < self.width)
+                    alive &= inside
+                    cell = self.boards[self.index, np.clip(r, 0, self.height-1), np.clip(c, 0, self.width-1)]
+                    alive &= cell == pieces
+                    length += alive
+            won |= length >= self.streak
+        return won
+
+    def winning_moves(self, pieces):
+        """ (N, W) bool array of the columns where pieces[i] would win game i right now
+        """
+        legal = self.legal_mask()
+        moves = np.zeros((self.num_games, self.width), dtype=bool)
+        for col in range(self.width):
+            cols = np.full(self.num_games, col)
+            rows = np.minimum(self.heights[:, col], self.height-1)
+            moves[:, col] = legal[:, col] & self.wins_at(rows, cols, pieces)
+        return moves
+
+    def step(self, actions):
+        """ Play actions[i] in game i for its side to move.
+
+            Returns (rewards, dones, legal): reward 1 to the mover for a win, -1 for
+            an illegal move (which also ends the game), 0 otherwise; whether each game
+            ended; and the legal-move mask of the boards after finished games are reset.
+            The winner (X, O or EMPTY for a draw) of each finished game is in self.winners.
+        """
+        actions = np.asarray(actions, dtype=np.int64)
+        pieces = self.turn.copy()
+        illegal = self.heights[self.index, actions] >= self.height
+        legal = ~illegal
+        rows = np.minimum(self.heights[self.index, actions], self.height-1)
+
+        self.boards[self.index[legal], rows[legal], actions[legal]] = pieces[legal]
+        self.heights[self.index[legal], actions[legal]] += 1
+
+        won = legal & self.wins_at(rows, actions, pieces)
+        full = (self.heights == self.height).all(axis=1)
+        dones = won | illegal | full
+
+        rewards = np.zeros(self.num_games, dtype=np.float64)
+        rewards[won] = 1
+        rewards[illegal] = -1
+        self.winners[dones] = EMPTY
+        self.winners[won] = pieces[won]
+        self.winners[illegal] = -pieces[illegal]
+
+        self.turn = -self.turn
+        self.reset(dones)
+        return rewards, dones, self.legal_mask()
+
+def random_policy(legal, rng):
+    """ A uniformly random legal column for every game
+    """
+    scores = rng.random(legal.shape)
+    return np.argmax(np.where(legal, scores, -1), axis=1)
+
+def greedy_policy(env, rng):
+    """ Win if possible, else block the opponent's winning column, else play at random
+    """
+    legal = env.legal_mask()
+    wins = env.winning_moves(env.turn)
+    blocks = env.winning_moves(-env.turn)
+    scores = rng.random(legal.shape) + 2*blocks + 4*wins
+    return np.argmax(np.where(legal, scores, -1), axis=1)